@@ -1,15 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sys
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 import pandas as pd
 import numpy as np
-current_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(current_dir)
-sys.path.append(parent_dir)
-from models import QCEWComp, NAICStoBEA
+from scipy import sparse
+from lookup_tables import get_lookup_files, compile_bridge, get_compiled_bridge, bridge_ownership_codes
 
 # create database session
 def db_session():
@@ -21,75 +18,81 @@ def db_session():
     return Session
 
 # class with methods to convert QCEW data to BEA sectors
+# wage_name and emp_name are column names, or lists of column names to convert several estimates at once
+# the lookup tables are shared by every instance (see lookup_tables.py); snapshot_dir optionally names a
+# folder to keep a snapshot of the parsed lookup files in
 class QCEWtoBEA:
-    def __init__(self, qcew_data, ownership_code, wage_name, emp_name):
+    def __init__(self, qcew_data, ownership_code, wage_name, emp_name, snapshot_dir=None):
         self.csv_data = qcew_data
-        self.ownership_code = ownership_code
+        self.snapshot_dir = snapshot_dir
+        self.ownership_code = int(ownership_code)
         self.wage_name = wage_name
         self.emp_name = emp_name
+        wage_names = [wage_name] if isinstance(wage_name, str) else list(wage_name)
+        emp_names = [emp_name] if isinstance(emp_name, str) else list(emp_name)
+        self.value_cols = ['tap_estabs_count'] + wage_names + emp_names
+        self.bea_cols = [col + '_bea' for col in self.value_cols]
 
-    def bea_bridge(self, bridge_df, data):
-        if data:
-            csv_data = data.copy()
-        else:
-            csv_data = self.csv_data.copy()
-        bea = pd.read_csv('./files/bea_cols.csv', dtype=str)
-        naics = pd.read_csv('./files/naics_rows.csv', dtype=str)
-        if naics['naics >>'].isnull().values.any():
-            naics = naics.dropna(subset=['naics >>'])
-        naics['naics >>'] = naics['naics >>'].astype(int)
-        if bea['column_index'].isnull().values.any():
-            bea = bea.dropna(subset=['column_index'])
-        bea['column_index'] = bea['column_index'].astype(int)
-        sectors = pd.read_csv('./files/BEA_sectors.csv')
+    # convert the data with the bridge rows of one ownership code
+    def bea_bridge(self, bridge_df, data=None):
+        return self.convert(compile_bridge(bridge_df, *get_lookup_files(self.snapshot_dir)), data)
+
+    # convert the data with a compiled bridge (see lookup_tables.compile_bridge)
+    # the data is laid out as a sparse (county, ownership, year) x NAICS matrix for each of the establishment,
+    # wage and employment columns, and all of them are converted with one product with the compiled bridge
+    def convert(self, bridge, data=None):
+        csv_data = self.csv_data if data is None else data
+        naics_codes, labels, coeffs, links = bridge
 
-        csv_data = csv_data.merge(naics, left_on='naics_code', right_on='naics6_code')
-        csv_data = csv_data.merge(bridge_df, left_on='naics >>', right_on='r_seq', suffixes=('', '_y'))
-        csv_data = csv_data.merge(bea, left_on='c_seq', right_on='column_index')
-        csv_data['own_code'] = csv_data['own_code'].astype(int)
-        csv_data['tap_estabs_count'] = csv_data['tap_estabs_count'].astype(int)
-        csv_data[self.wage_name] = csv_data[self.wage_name].astype(int)
-        csv_data[self.emp_name] = csv_data[self.emp_name].astype(int)
-        csv_data['naics_to_io_coeffs'] = csv_data['naics_to_io_coeffs'].astype(float)
+        # one row for every county, ownership and year, one column for every NAICS code of the bridge
+        # rows with a NAICS code that isn't in the bridge or a missing county, ownership or year are left out
+        naics_index = naics_codes.get_indexer(csv_data['naics_code'])
+        key_codes, key_values = zip(*(pd.factorize(csv_data[col]) for col in ['area_fips', 'own_code', 'year']))
+        known = (naics_index >= 0) & np.all([codes >= 0 for codes in key_codes], axis=0)
+        csv_data = csv_data[known]
+        naics_index = naics_index[known]
+        key_shape = tuple(len(values) for values in key_values)
+        group_index, group_keys = pd.factorize(np.ravel_multi_index(tuple(codes[known] for codes in key_codes), key_shape))
+        groups = pd.DataFrame({col: np.asarray(values)[index] for col, values, index in
+                               zip(['area_fips', 'own_code', 'year'], key_values, np.unravel_index(group_keys, key_shape))})
+        groups['own_code'] = groups['own_code'].astype(int)
+        shape = (len(groups), len(naics_codes))
+        values = csv_data[self.value_cols].astype(int).to_numpy(dtype=float)
+        data_mat = sparse.vstack([sparse.csr_matrix((values[:, i], (group_index, naics_index)), shape=shape) for i in range(len(self.value_cols))])
+        converted = sparse.coo_matrix(data_mat @ coeffs)
 
-        csv_data[self.wage_name + '_bea'] = np.array(csv_data[self.wage_name].tolist()) * np.array(csv_data['naics_to_io_coeffs'].tolist())
-        csv_data[self.emp_name + '_bea'] = np.array(csv_data[self.emp_name].tolist()) * np.array(csv_data['naics_to_io_coeffs'].tolist())
-        csv_data['tap_estabs_count_bea'] = np.array(csv_data['tap_estabs_count'].tolist()) * np.array(csv_data['naics_to_io_coeffs'].tolist())
-        csv_data = csv_data.drop(['naics >>', 'column_index', 'r_seq', 'c_seq', 'naics_to_io_coeffs', self.wage_name, self.emp_name, 'tap_estabs_count', 'naics_code', 'naics6_code'], axis=1)
-        csv_data = csv_data.groupby(['area_fips', 'bea_code', 'own_code', 'year'])[["tap_estabs_count_bea", self.wage_name + '_bea', self.emp_name + '_bea']].sum().reset_index()
-        csv_data['bea_num'] = [x.split('_')[1] for x in csv_data['bea_code'].tolist()]
-        csv_data = csv_data.merge(sectors, left_on="bea_num", right_on="Num")
-        csv_data.pop('Num')
-        csv_data.insert(0, 'bea_num', csv_data.pop('bea_num'))
-        csv_data.insert(1, 'bea_name', csv_data.pop('Name'))
-        csv_data.insert(2, 'bea_code', csv_data.pop('bea_code'))
+        # every BEA sector linked to a NAICS code in the data gets a row, even when its total is zero
+        present = sparse.csr_matrix((np.ones(len(group_index)), (group_index, naics_index)), shape=shape)
+        linked = sparse.csr_matrix(present @ links)
+        linked.sort_indices()
+        rows, cols = linked.nonzero()
+        csv_data = pd.concat([labels.iloc[cols].reset_index(drop=True), groups.iloc[rows].reset_index(drop=True)], axis=1)
+        converted_rows = converted.row % len(groups)
+        position = np.searchsorted(rows * len(labels) + cols, converted_rows * len(labels) + converted.col)
+        for i, col in enumerate(self.bea_cols):
+            csv_data[col] = 0.0
+            measure = converted.row // len(groups) == i
+            csv_data.loc[position[measure], col] = converted.data[measure]
+        csv_data = csv_data.sort_values(['area_fips', 'bea_code', 'own_code', 'year'], kind='stable', ignore_index=True)
         return csv_data
 
+    # convert the data of every ownership code with the compiled bridge of that ownership code and add it up into
+    # ownership 0 totals for every BEA sector and year (summed over counties)
+    # bridges maps ownership codes to their compiled bridges; rows of other ownership codes are left out
+    def convert_total(self, bridges, data=None):
+        csv_data = self.csv_data if data is None else data
+        out_data = pd.concat([self.convert(bridge, csv_data[csv_data.own_code == code]) for code, bridge in bridges.items()])
+        out_data = out_data.drop(['own_code'], axis=1)
+        out_data.insert(2, "own_code", 0, allow_duplicates=True)
+        return out_data.groupby(['bea_num', 'bea_name', 'bea_code', 'own_code', 'year'])[self.bea_cols].sum().reset_index()
+
+    # ownership 0 converts the rows of the ownership codes in the bridge (1, 2, 3 and 5) into their total
     def bea_conversion(self):
         session = db_session()
-        bridge_cols = [
-            NAICStoBEA.r_seq, 
-            NAICStoBEA.c_seq, 
-            NAICStoBEA.r_naics6_code, 
-            NAICStoBEA.c_bea_code_2_lvl_6, 
-            NAICStoBEA.naics_to_io_coeffs,
-            NAICStoBEA.bls_own_code
-        ]
         if self.ownership_code == 0:
-            out_data = pd.DataFrame()
-            bridge_data = session.query(*bridge_cols).all()
-            bridge_df = pd.DataFrame.from_records(bridge_data, columns=['r_seq', 'c_seq', 'r_naics6_code', 'c_bea_code_2_lvl_6', 'naics_to_io_coeffs', 'own_code'])
-            for code in bridge_df.own_code.unique():
-                bridge_sub = bridge_df[bridge_df.own_code == code]
-                csv_data_sub = self.csv_data[self.csv_data.own_code == code]
-                csv_out_sub = self.bea_bridge(bridge_sub, csv_data_sub)
-                out_data = pd.concat([out_data, csv_out_sub])
-            out_data = out_data.drop(['own_code'], axis=1)
-            out_data.insert(2, "own_code", 0, allow_duplicates=True)
-            out_data = out_data.groupby(['bea_num', 'bea_name', 'bea_code', 'own_code', 'year'])[["tap_estabs_count_bea", wage_name + '_bea', emp_name + '_bea']].sum().reset_index()
-            csv_data = out_data.copy()
+            bridges = {code: get_compiled_bridge(session, code, self.snapshot_dir) for code in bridge_ownership_codes(session)}
+            csv_data = self.convert_total(bridges)
         else:
-            bridge_data = session.query(*bridge_cols).filter(NAICStoBEA.bls_own_code == self.ownership_code).all()
-            bridge_df = pd.DataFrame.from_records(bridge_data, columns=['r_seq', 'c_seq', 'r_naics6_code', 'c_bea_code_2_lvl_6', 'naics_to_io_coeffs', 'oen_code'])
-            csv_data = self.bea_bridge(bridge_df, None)
+            csv_data = self.convert(get_compiled_bridge(session, self.ownership_code, self.snapshot_dir))
+        session.remove()
         self.csv_data = csv_data
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Lookup tables used by the QCEW to BEA conversion.
+
+The NAICS row and BEA column indexes of the bridge (files/naics_rows.csv and
+files/bea_cols.csv), the BEA sector names (files/BEA_sectors.csv) and the bridge
+table in the database are loaded and validated once per process and kept in
+memory, together with the bridge of every ownership code compiled into a sparse
+NAICS x BEA matrix. Every QCEWtoBEA instance shares them. clear_cache() drops
+everything, so changed files or bridge rows are picked up by the next call.
+
+The parsed files can also be saved as a pickle snapshot in a cache folder. The
+snapshot is keyed by a hash of the files, so it's rebuilt whenever they change.
+
+"""
+
+import contextlib
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+from scipy import sparse
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from models import NAICStoBEA
+
+# the lookup files are found relative to this file, not the working directory
+FILES_DIR = os.path.join(current_dir, 'files')
+LOOKUP_FILES = ['naics_rows.csv', 'bea_cols.csv', 'BEA_sectors.csv']
+BRIDGE_COLUMNS = ['r_seq', 'c_seq', 'r_naics6_code', 'c_bea_code_2_lvl_6', 'naics_to_io_coeffs', 'own_code']
+
+# in-memory cache shared by every QCEWtoBEA instance in this process
+_cache = {}
+
+
+# drop the cached lookup tables and compiled bridges
+def clear_cache():
+    _cache.clear()
+
+# hash of the contents of the lookup files, used to tell when a snapshot is out of date
+def files_fingerprint(files_dir=FILES_DIR):
+    digest = hashlib.sha256()
+    for name in LOOKUP_FILES:
+        digest.update(name.encode('utf-8'))
+        with open(os.path.join(files_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+# make sure a lookup table has the columns the conversion needs
+def check_columns(df, name, columns):
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        raise ValueError('{0} is missing the column(s) {1}'.format(name, ', '.join(missing)))
+
+# read and validate the NAICS row and BEA column indexes of the bridge and the BEA sector names
+# rows without an index are left out
+def read_lookup_files(files_dir=FILES_DIR):
+    naics = pd.read_csv(os.path.join(files_dir, 'naics_rows.csv'), dtype=str)
+    check_columns(naics, 'naics_rows.csv', ['naics6_code', 'naics >>'])
+    naics = naics.dropna(subset=['naics >>'])
+    naics['naics >>'] = naics['naics >>'].astype(int)
+
+    bea = pd.read_csv(os.path.join(files_dir, 'bea_cols.csv'), dtype=str)
+    check_columns(bea, 'bea_cols.csv', ['bea_code', 'column_index'])
+    bea = bea.dropna(subset=['column_index'])
+    bea['column_index'] = bea['column_index'].astype(int)
+    if not bea['bea_code'].str.contains('_').all():
+        raise ValueError('bea_cols.csv has bea codes without a sector number (<index>_<sector number>)')
+
+    sectors = pd.read_csv(os.path.join(files_dir, 'BEA_sectors.csv'))
+    check_columns(sectors, 'BEA_sectors.csv', ['Num', 'Name'])
+    if sectors['Num'].duplicated().any():
+        raise ValueError('BEA_sectors.csv has duplicate sector numbers')
+    return naics, bea, sectors
+
+def snapshot_path(snapshot_dir, fingerprint):
+    return os.path.join(snapshot_dir, 'lookup_tables_{0}.pkl'.format(fingerprint))
+
+# save the parsed lookup files, removing snapshots of older versions of the files
+# several processes can save the same snapshot at once, so snapshots another process already removed are skipped
+def save_snapshot(snapshot_dir, fingerprint, tables):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = snapshot_path(snapshot_dir, fingerprint)
+    for old_path in glob.glob(os.path.join(snapshot_dir, 'lookup_tables_*.pkl')):
+        if old_path != path:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(old_path)
+    # write to a temporary file first so a crash never leaves a partial snapshot behind
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+# load the parsed lookup files from a snapshot, or None if there is no snapshot for this fingerprint
+def load_snapshot(snapshot_dir, fingerprint):
+    try:
+        with open(snapshot_path(snapshot_dir, fingerprint), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+# the parsed lookup files (naics rows, bea columns and sectors)
+# snapshot_dir optionally names a folder to load them from or save them to
+def get_lookup_files(snapshot_dir=None):
+    if 'files' not in _cache:
+        tables = None
+        if snapshot_dir:
+            fingerprint = files_fingerprint()
+            tables = load_snapshot(snapshot_dir, fingerprint)
+        if tables is None:
+            tables = read_lookup_files()
+            if snapshot_dir:
+                save_snapshot(snapshot_dir, fingerprint, tables)
+        _cache['files'] = tables
+    return _cache['files']
+
+# the bridge rows of every ownership code, queried once per process
+def get_bridge(session):
+    if 'bridge' not in _cache:
+        bridge_data = session.query(
+            NAICStoBEA.r_seq,
+            NAICStoBEA.c_seq,
+            NAICStoBEA.r_naics6_code,
+            NAICStoBEA.c_bea_code_2_lvl_6,
+            NAICStoBEA.naics_to_io_coeffs,
+            NAICStoBEA.bls_own_code
+        ).all()
+        bridge_df = pd.DataFrame.from_records(bridge_data, columns=BRIDGE_COLUMNS)
+        if bridge_df[['r_seq', 'c_seq', 'naics_to_io_coeffs', 'own_code']].isnull().values.any():
+            raise ValueError('the NAICS to BEA bridge has rows without a sequence number, coefficient or ownership code')
+        bridge_df['own_code'] = bridge_df['own_code'].astype(int)
+        _cache['bridge'] = bridge_df
+    return _cache['bridge']
+
+# the ownership codes in the bridge that ownership 0 is the total of (0 itself is left out)
+def bridge_ownership_codes(session):
+    return sorted(code for code in get_bridge(session)['own_code'].unique().tolist() if code != 0)
+
+# compile the bridge rows of one ownership code into a sparse NAICS x BEA matrix of conversion coefficients
+# NAICS codes are linked to the bridge rows through naics_rows.csv, the bridge columns to BEA codes through
+# bea_cols.csv and the BEA codes to their sector names through BEA_sectors.csv. Coefficients linking the same
+# NAICS and BEA codes are added together. BEA codes without a sector are left out.
+# returns the NAICS codes (rows), the labels of the BEA codes (columns, sorted by bea_code), the coefficients
+# and a matrix of ones marking every link, so that links with a zero coefficient are kept
+def compile_bridge(bridge_df, naics, bea, sectors):
+    bridge = naics.merge(bridge_df, left_on='naics >>', right_on='r_seq', suffixes=('', '_y'))
+    bridge = bridge.merge(bea, left_on='c_seq', right_on='column_index')
+    bridge['bea_num'] = [x.split('_')[1] for x in bridge['bea_code'].tolist()]
+    bridge = bridge.merge(sectors, left_on='bea_num', right_on='Num')
+    rows, naics_codes = pd.factorize(bridge['naics6_code'])
+    cols, bea_codes = pd.factorize(bridge['bea_code'], sort=True)
+    labels = bridge.iloc[np.unique(cols, return_index=True)[1]]
+    labels = pd.DataFrame({'bea_num': labels['bea_num'].to_numpy(), 'bea_name': labels['Name'].to_numpy(), 'bea_code': labels['bea_code'].to_numpy()})
+    shape = (len(naics_codes), len(bea_codes))
+    coeffs = sparse.csr_matrix((bridge['naics_to_io_coeffs'].to_numpy(dtype=float), (rows, cols)), shape=shape)
+    links = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+    return pd.Index(naics_codes), labels, coeffs, links
+
+# the compiled bridge of one ownership code, compiled once per process
+def get_compiled_bridge(session, ownership_code, snapshot_dir=None):
+    key = ('compiled_bridge', int(ownership_code))
+    if key not in _cache:
+        bridge_df = get_bridge(session)
+        _cache[key] = compile_bridge(bridge_df[bridge_df.own_code == int(ownership_code)], *get_lookup_files(snapshot_dir))
+    return _cache[key]
@@ -1,19 +1,22 @@
 # -*- coding: utf-8 -*-
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker, scoped_session
 import os 
 import sys 
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-from itertools import product
 from conversion import QCEWtoBEA
+from lookup_tables import bridge_ownership_codes, get_lookup_files
 # models are in the parent directory, so we need to adjust the path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
-from models import QCEWComp, NAICStoBEA
+from models import QCEWComp
 
 
 # load environment variables
@@ -27,9 +30,14 @@ Session = scoped_session(session_factory)
 
 # define command line arguments
 parser = argparse.ArgumentParser(description='This program is used to convert QCEW data from 6 digit NAICS codes to BEA sectors.')
-parser.add_argument('-ownership', help="The QCEW ownership code is required to run the program. Allowed values include 0, 1, 2, 3, 5.", required=True)
-parser.add_argument('-year', help="A year corresponding to QCEW data must be provided. Currently supported years include 2001-2021", required=True)
-parser.add_argument('-employer_wage', help="The employer wage number that you wish to convert. Allowed values include 1, 2, 3, 4, 5.", required=True)
+parser.add_argument('-ownership', help="The QCEW ownership code is required to run the program. Allowed values include 0, 1, 2, 3, 5. Several codes can be given as a comma separated list (e.g. -ownership=1,2,3,5).", required=True)
+parser.add_argument('-year', help="A year corresponding to QCEW data must be provided. Currently supported years include 2001-2021. Several years can be given as a range and/or a comma separated list (e.g. -year=2001-2021 or -year=2010,2015).", required=True)
+parser.add_argument('-employer_wage', help="The employer wage number that you wish to convert. Allowed values include 1, 2, 3, 4, 5. Several numbers can be given as a range and/or a comma separated list (e.g. -employer_wage=1-5).", required=True)
+parser.add_argument('-workers', type=int, default=1, help="The number of years converted at the same time. Every worker holds a year of QCEW data and its own copy of the lookup tables in memory, so memory use grows with the number of workers. The default is 1.", required=False)
+parser.add_argument('-lookup_cache', help="A folder to keep a snapshot of the parsed lookup files (files/*.csv) in. The snapshot is rebuilt whenever the files change.", required=False)
+parser.add_argument('-stream', action='store_true', help="Stream the QCEW data from the database and convert it one state at a time, so memory use stays bounded however many counties are converted. The output is the same.", required=False)
+parser.add_argument('-chunk_size', type=int, default=100000, help="The number of QCEW rows fetched at a time with -stream. The default is 100000.", required=False)
+parser.add_argument('-no_densify', action='store_true', help="Don't add zero rows for the county/NAICS combinations that are missing from the QCEW data. The converted totals are the same, but BEA sectors that are zero in a county are left out of the output.", required=False)
 
 # given employer wage number, create field list
 def create_field_list(emp_wage_number):
@@ -62,42 +70,201 @@ def create_field_list(emp_wage_number):
     field_list.append(emp_info[0])
     return field_list, wage_info[1], emp_info[1]
 
-# given a list of tuples, find outliers
-def find_outliers(list1, list2):
-    t_length = len(list2[0])
-    set2 = {tuple(t[:4]) for t in list2}
-    outliers = []
-    for tuple1 in list1:
-        if tuple(tuple1[:4]) not in set2:
-            outlier = tuple1 + (0,) * (t_length - 4)  # Add zeros to make same length as tuple1
-            outliers.append(outlier)
-    return outliers
-
-# given user provided arguments, pull the QCEW data, generate all possible value combinations, and fill missing combinations with zeros
-def get_QCEW(args):
+# given a list of employer wage numbers, create the field list with the wage and employment fields of all of them
+def create_batch_field_list(emp_wage_numbers):
+    wage_fields, emp_fields, wage_col_names, emp_col_names = [], [], [], []
+    for emp_wage_number in emp_wage_numbers:
+        field_list, wage_col_name, emp_col_name = create_field_list(emp_wage_number)
+        wage_fields.append(field_list[-2])
+        emp_fields.append(field_list[-1])
+        wage_col_names.append(wage_col_name)
+        emp_col_names.append(emp_col_name)
+    return field_list[:-2] + wage_fields + emp_fields, wage_col_names, emp_col_names
+
+# parse a comma separated list of values and start-stop ranges (e.g. 2001-2005,2010) into a list of ints
+# raises ValueError for ranges that end before they start
+def parse_values(values):
+    parsed = []
+    for part in str(values).split(','):
+        if '-' in part:
+            start, stop = part.split('-')
+            if int(stop) < int(start):
+                raise ValueError('invalid range {0}, the range ends before it starts'.format(part))
+            parsed.extend(range(int(start), int(stop) + 1))
+        else:
+            parsed.append(int(part))
+    return list(dict.fromkeys(parsed))
+
+# add a row of zeros for every combination of the key column values that is missing from the data
+# the missing rows are appended in the order of the combinations (the first key column varies slowest)
+# key_values optionally gives all the values of some key columns, for data that is a chunk of a larger data set
+def densify(df, key_columns, key_values=None):
+    key_values = key_values or {}
+    codes, uniques = [], []
+    for col in key_columns:
+        if col in key_values:
+            all_values = np.asarray(key_values[col], dtype=object)
+            col_codes, col_uniques = pd.factorize(np.concatenate([all_values, df[col].to_numpy(dtype=object)]), use_na_sentinel=False)
+            col_codes = col_codes[len(all_values):]
+        else:
+            col_codes, col_uniques = pd.factorize(df[col], use_na_sentinel=False)
+        codes.append(col_codes)
+        uniques.append(col_uniques)
+    shape = tuple(len(values) for values in uniques)
+    present = np.zeros(int(np.prod(shape)), dtype=bool)
+    present[np.ravel_multi_index(codes, shape)] = True
+    missing = np.unravel_index(np.flatnonzero(~present), shape)
+    zeros = pd.DataFrame({col: np.asarray(values)[index] for col, values, index in zip(key_columns, uniques, missing)})
+    for col in df.columns.difference(key_columns):
+        zeros[col] = 0
+    return pd.concat([df, zeros[df.columns]], ignore_index=True)
+
+# the ownership codes of the QCEW rows that every ownership code is converted from
+# ownership 0 is the total of the ownership codes in the bridge (1, 2, 3 and 5), so it's converted from their rows
+def get_source_ownerships(ownerships):
+    bridge_codes = []
+    if 0 in ownerships:
+        session = Session()
+        bridge_codes = bridge_ownership_codes(session)
+        Session.remove()
+    return {ownership: bridge_codes if ownership == 0 else [ownership] for ownership in ownerships}
+
+# pull the QCEW data of one year for the given ownership codes, with the wage and employment fields of every employer wage number
+def get_QCEW(year, ownerships, employer_wages):
+    session = Session()
+    field_list, wage_col_names, emp_col_names = create_batch_field_list(employer_wages)
+    query = session.query(*field_list).filter(QCEWComp.year == year).filter(QCEWComp.own_code.in_(ownerships)).all()
+    csv_data = pd.DataFrame.from_records(query, columns=['area_fips', 'own_code', 'naics_code', 'year', 'tap_estabs_count'] + wage_col_names + emp_col_names)
+    Session.remove()
+    return csv_data, wage_col_names, emp_col_names
+
+# stream the QCEW data of one year for the given ownership codes, one state (the first two digits of the county
+# FIPS code) at a time. Rows are fetched chunk_size at a time (with a server-side cursor where the database
+# supports it) and every state is yielded as a data frame as soon as all of its rows have arrived.
+# rows without a county are left out, as the conversion drops them
+def stream_QCEW(year, ownerships, employer_wages, chunk_size=100000):
+    session = Session()
+    field_list, wage_col_names, emp_col_names = create_batch_field_list(employer_wages)
+    columns = ['area_fips', 'own_code', 'naics_code', 'year', 'tap_estabs_count'] + wage_col_names + emp_col_names
+    query = (
+        select(*field_list)
+        .where(QCEWComp.year == year)
+        .where(QCEWComp.own_code.in_(ownerships))
+        .where(QCEWComp.area_fips.isnot(None))
+        .order_by(QCEWComp.area_fips)
+        .execution_options(yield_per=chunk_size)
+    )
+    pending, pending_state, yielded = [], None, False
+    try:
+        for rows in session.execute(query).partitions():
+            chunk = pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+            states = chunk['area_fips'].str[:2].to_numpy()
+            bounds = np.flatnonzero(states[1:] != states[:-1]) + 1
+            for start, stop in zip([0] + bounds.tolist(), bounds.tolist() + [len(chunk)]):
+                if pending and states[start] != pending_state:
+                    yield pd.concat(pending, ignore_index=True)
+                    pending, yielded = [], True
+                pending.append(chunk.iloc[start:stop])
+                pending_state = states[start]
+        if pending or not yielded:
+            yield pd.concat(pending, ignore_index=True) if pending else pd.DataFrame(columns=columns)
+    finally:
+        Session.remove()
+
+# the NAICS codes in the QCEW data of one year, for every ownership code
+# used to fill missing combinations with zeros when the data is converted in chunks
+def get_QCEW_naics_codes(year, ownerships):
     session = Session()
-    field_list, wage_col_name, emp_col_name = create_field_list(args.employer_wage)
-    query = session.query(*field_list).filter(QCEWComp.year == args.year).filter(QCEWComp.own_code == args.ownership).all()
-    csv_data = pd.DataFrame.from_records(query, columns=['area_fips', 'own_code', 'naics_code', 'year', 'tap_estabs_count', wage_col_name, emp_col_name])
-    fips = csv_data.area_fips.unique()
-    naics = csv_data.naics_code.unique()
-    ownership = csv_data.own_code.unique()
-    year = csv_data.year.unique()
-    csv_data = None
-    param_combos = list(product(fips, ownership, naics, year))
-    outliers = find_outliers(param_combos, query)
-    out_data = query + outliers
-    csv_data = pd.DataFrame(out_data, columns=['area_fips', 'own_code', 'naics_code', 'year', 'tap_estabs_count', wage_col_name, emp_col_name])
-    return csv_data, wage_col_name, emp_col_name
-
-# get the formatted QCEW data and run the BEA conversion
+    query = session.query(QCEWComp.own_code, QCEWComp.bls_own_code).filter(QCEWComp.year == year).filter(QCEWComp.own_code.in_(ownerships)).distinct().all()
+    Session.remove()
+    naics_codes = {ownership: [] for ownership in ownerships}
+    for own_code, naics_code in query:
+        naics_codes[own_code].append(naics_code)
+    return naics_codes
+
+# convert one year of QCEW data for every ownership code and employer wage number
+# the data is pulled once, and all employer wage numbers of an ownership code are converted together.
+# With chunk_size, the data is streamed and converted one state at a time: county rows are appended to the
+# output files as they're converted and the ownership 0 totals (summed over counties) are added up as they go.
+# returns the paths of the output files
+def convert_year(year, ownerships, employer_wages, no_densify=False, lookup_cache=None, chunk_size=None):
+    wage_names, emp_names = create_batch_field_list(employer_wages)[1:]
+    bea_cols = [col + '_bea' for col in ['tap_estabs_count'] + wage_names + emp_names]
+    key_columns = ['area_fips', 'own_code', 'naics_code', 'year']
+    sources = get_source_ownerships(ownerships)
+    source_codes = sorted(set(code for codes in sources.values() for code in codes))
+    if chunk_size:
+        chunks = stream_QCEW(year, source_codes, employer_wages, chunk_size)
+        naics_codes = None if no_densify else get_QCEW_naics_codes(year, source_codes)
+    else:
+        chunks = [get_QCEW(year, source_codes, employer_wages)[0]]
+        naics_codes = None
+    # output is saved to the output folder (not tracked by git)
+    paths = {(ownership, employer_wage): './output/emp_wage_bea_{0}_{1}_{2}.csv'.format(year, ownership, employer_wage)
+             for ownership in ownerships for employer_wage in employer_wages}
+    written = set()
+    totals = {}
+
+    # write the converted data of an ownership code to its output files, appending after the first chunk
+    def write_outputs(ownership, csv_data):
+        label_cols = [col for col in csv_data.columns if col not in bea_cols]
+        for employer_wage, wage_name, emp_name in zip(employer_wages, wage_names, emp_names):
+            path = paths[(ownership, employer_wage)]
+            first = path not in written
+            csv_data[label_cols + ['tap_estabs_count_bea', wage_name + '_bea', emp_name + '_bea']].to_csv(path, index=False, mode='w' if first else 'a', header=first)
+            written.add(path)
+
+    for chunk in chunks:
+        for ownership in ownerships:
+            frames = [chunk[chunk.own_code == code] for code in sources[ownership]]
+            # fill missing combinations with zeros, separately for every ownership code
+            if not no_densify:
+                frames = [densify(df, key_columns, {'naics_code': naics_codes[code]} if naics_codes else None) for df, code in zip(frames, sources[ownership])]
+            ownership_df = pd.concat(frames, ignore_index=True)
+            qcew_to_bea = QCEWtoBEA(ownership_df, ownership, wage_names, emp_names, lookup_cache)
+            qcew_to_bea.bea_conversion()
+            if ownership == 0:
+                group_cols = [col for col in qcew_to_bea.csv_data.columns if col not in bea_cols]
+                total = pd.concat([totals[ownership], qcew_to_bea.csv_data]) if ownership in totals else qcew_to_bea.csv_data
+                totals[ownership] = total.groupby(group_cols)[bea_cols].sum().reset_index()
+            else:
+                write_outputs(ownership, qcew_to_bea.csv_data)
+    for ownership, total in totals.items():
+        write_outputs(ownership, total)
+    return list(paths.values())
+
+# get the formatted QCEW data and run the BEA conversion for every year, ownership code and employer wage number
 def main():
     args = parser.parse_args()
-    qcew_df, wage_name, emp_name = get_QCEW(args)
-    qcew_to_bea = QCEWtoBEA(qcew_df, args.ownership, wage_name, emp_name)
-    qcew_to_bea.bea_conversion()
-    # output is saved to the output folder (not tracked by git)
-    qcew_to_bea.csv_data.to_csv('./output/emp_wage_bea_{0}_{1}_{2}.csv'.format(args.year, args.ownership, args.employer_wage), index=False)
+    try:
+        years = parse_values(args.year)
+        ownerships = parse_values(args.ownership)
+        employer_wages = parse_values(args.employer_wage)
+    except ValueError as e:
+        print('ERROR: {0}'.format(str(e).upper()))
+        exit()
+    if any(ownership not in [0, 1, 2, 3, 5] for ownership in ownerships):
+        print('ERROR: INVALID OWNERSHIP CODE')
+        exit()
+    if any(employer_wage not in [1, 2, 3, 4, 5] for employer_wage in employer_wages):
+        print('ERROR: INVALID EMPLOYER WAGE NUMBER')
+        exit()
+
+    chunk_size = args.chunk_size if args.stream else None
+    workers = min(args.workers, len(years))
+    if workers <= 1:
+        for year in years:
+            convert_year(year, ownerships, employer_wages, args.no_densify, args.lookup_cache, chunk_size)
+        return
+    # write the lookup snapshot once before the workers start, so they all load it instead of saving it at the same time
+    if args.lookup_cache:
+        get_lookup_files(args.lookup_cache)
+    # years are converted in separate processes, each with its own database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(convert_year, year, ownerships, employer_wages, args.no_densify, args.lookup_cache, chunk_size): year for year in years}
+        for future in as_completed(futures):
+            paths = future.result()
+            print('Converted {0}: {1} files'.format(futures[future], len(paths)))
 
 # only run main if this file is being run directly
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from conversion import QCEWtoBEA
+from lookup_tables import compile_bridge, read_lookup_files
+
+OWNERSHIP_CODES = [1, 2, 3, 5]
+WAGE_NAMES = ['tap_wages_est_1', 'tap_wages_est_2']
+EMP_NAMES = ['tap_emplvl_est_1', 'tap_emplvl_est_2']
+
+
+# compile a bridge for every ownership code that links the first NAICS rows to a few BEA columns each
+def make_bridges(rng, naics_count=30, links=2):
+    naics, bea, sectors = read_lookup_files()
+    naics = naics.head(naics_count)
+    columns = bea['column_index'].head(20).to_numpy()
+    bridges = {}
+    for code in OWNERSHIP_CODES:
+        rows = [(r_seq, c_seq, naics_code, 'x', float(rng.random()), code)
+                for r_seq, naics_code in zip(naics['naics >>'], naics['naics6_code'])
+                for c_seq in rng.choice(columns, links, replace=False)]
+        bridge_df = pd.DataFrame(rows, columns=['r_seq', 'c_seq', 'r_naics6_code', 'c_bea_code_2_lvl_6', 'naics_to_io_coeffs', 'own_code'])
+        bridges[code] = compile_bridge(bridge_df, naics, bea, sectors)
+    return naics['naics6_code'].tolist(), bridges
+
+# QCEW rows for a few counties, ownership codes (including ownership 0 rows) and NAICS codes
+def make_data(rng, naics_codes):
+    rows = []
+    for area_fips in ['16001', '16003', '41005', '53001']:
+        for own_code in [0, 1, 3, 5]:
+            for naics_code in rng.choice(naics_codes, 12, replace=False):
+                rows.append([area_fips, own_code, naics_code, 2020] + rng.integers(0, 1000, 5).tolist())
+    return pd.DataFrame(rows, columns=['area_fips', 'own_code', 'naics_code', 'year', 'tap_estabs_count'] + WAGE_NAMES + EMP_NAMES)
+
+def test_ownership_0_total_is_sum_of_ownerships():
+    rng = np.random.default_rng(0)
+    naics_codes, bridges = make_bridges(rng)
+    data = make_data(rng, naics_codes)
+
+    total = QCEWtoBEA(data, 0, WAGE_NAMES, EMP_NAMES).convert_total(bridges)
+    parts = []
+    for code in OWNERSHIP_CODES:
+        qcew_to_bea = QCEWtoBEA(data[data.own_code == code], code, WAGE_NAMES, EMP_NAMES)
+        parts.append(qcew_to_bea.convert(bridges[code]))
+    bea_cols = qcew_to_bea.bea_cols
+    expected = pd.concat(parts).groupby(['bea_code', 'year'])[bea_cols].sum()
+
+    assert (total['own_code'] == 0).all()
+    assert total[bea_cols].to_numpy().sum() > 0
+    result = total.set_index(['bea_code', 'year'])[bea_cols]
+    assert sorted(result.index) == sorted(expected.index)
+    assert np.allclose(result.loc[expected.index].to_numpy(), expected.to_numpy())
+
+# -stream adds up the ownership 0 totals of every state as it's converted
+def test_ownership_0_totals_add_up_over_states():
+    rng = np.random.default_rng(1)
+    naics_codes, bridges = make_bridges(rng)
+    data = make_data(rng, naics_codes)
+
+    total = QCEWtoBEA(data, 0, WAGE_NAMES, EMP_NAMES).convert_total(bridges)
+    states = [QCEWtoBEA(state_data, 0, WAGE_NAMES, EMP_NAMES).convert_total(bridges) for _, state_data in data.groupby(data['area_fips'].str[:2])]
+    bea_cols = [col for col in total.columns if col.endswith('_bea')]
+    group_cols = [col for col in total.columns if col not in bea_cols]
+    streamed = pd.concat(states).groupby(group_cols)[bea_cols].sum().reset_index()
+
+    assert streamed[group_cols].equals(total[group_cols])
+    assert np.allclose(streamed[bea_cols].to_numpy(), total[bea_cols].to_numpy())
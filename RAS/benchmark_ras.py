@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark RASProcessor on synthetic jobs stored in a local SQLite database.
+
+    The jobs use the ras_models tables (the ras schema is mapped onto the SQLite
+    database), so every phase runs the same code as a production job: loading,
+    freeze_negatives, the QC checks, the RAS iterations and the write-back are each
+    timed separately. The results are written as json so they can be compared
+    across versions.
+
+    Example:
+        python benchmark_ras.py --sizes 100x100 409x409 --densities 1 0.05 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from itertools import product
+import numpy as np
+import scipy
+import sqlalchemy
+from sqlalchemy import insert
+from ras_calculator import RASProcessor, RAS_SCHEMES, create_ras_engine
+from ras_models import Base, ExtantMatrix, ExtantRows, ExtantColumns, JobProperties
+
+
+# create a synthetic job and return its id
+# density is the share of non-zero cells, negative_share the share of those that are negative and
+# frozen_share the share of cells with an ad-hoc freeze value. The border totals are a random rescaling
+# of the matrix and always add up to the same (whole number) total, so the job passes the QC checks
+def create_job(engine, job_id, rows, cols, density=1.0, negative_share=0.0, frozen_share=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = np.round(rng.random((rows, cols)) * 100, 2)
+    matrix[rng.random((rows, cols)) >= density] = 0
+    negative = (matrix != 0) & (rng.random((rows, cols)) < negative_share)
+    matrix[negative] *= -1
+    adhoc = np.where(rng.random((rows, cols)) < frozen_share, np.round(rng.random((rows, cols)) * 100, 2), np.nan)
+
+    # totals of a rescaled non-negative matrix, adjusted so both sides add up to the same whole number
+    target = np.clip(np.where(np.isnan(adhoc), matrix, 0), 0, None) * (0.5 + rng.random((rows, cols)))
+    row_totals = np.round(target.sum(axis=1))
+    col_totals = np.round(target.sum(axis=0))
+    col_totals[np.argmax(col_totals)] += row_totals.sum() - col_totals.sum()
+
+    row_ids, col_ids = np.meshgrid(np.arange(1, rows + 1), np.arange(1, cols + 1), indexing='ij')
+    with engine.begin() as conn:
+        conn.execute(insert(JobProperties), [{'id': job_id, 'status': 'pending', 'max_ras_iterations': 1000}])
+        conn.execute(insert(ExtantMatrix), [
+            {'ras_id': job_id, 'row_id': row_id, 'col_id': col_id, 'amt_original': value, 'amt_to_freeze_adhoc': None if np.isnan(frozen) else frozen}
+            for row_id, col_id, value, frozen in zip(row_ids.ravel().tolist(), col_ids.ravel().tolist(), matrix.ravel().tolist(), adhoc.ravel().tolist())
+        ])
+        conn.execute(insert(ExtantRows), [{'ras_id': job_id, 'row_id': i + 1, 'amt_original': value} for i, value in enumerate(row_totals.tolist())])
+        conn.execute(insert(ExtantColumns), [{'ras_id': job_id, 'col_id': j + 1, 'amt_original': value} for j, value in enumerate(col_totals.tolist())])
+    return job_id
+
+# run one job and time every phase, in seconds
+def benchmark_job(engine, database_uri, job_id, max_iterations=1000, epsilon=0.00001, scheme='simultaneous'):
+    timings = {}
+    ras_processor = RASProcessor(database_uri, job_id, engine=engine)
+
+    start = time.perf_counter()
+    extant_matrix = ras_processor.get_extant_matrix(job_id)
+    bt_rows = ras_processor.get_bt_rows(job_id)
+    bt_cols = ras_processor.get_bt_cols(job_id)
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ras_bt_rows, ras_bt_cols, ras_mat, frozen_bt_rows, frozen_bt_cols, frozen_mat = ras_processor.freeze_negatives(bt_rows, bt_cols, extant_matrix)
+    timings['freeze_negatives'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ras_processor.qc_check0(bt_rows, bt_cols, ras_mat)
+    ras_processor.qc_check1(bt_rows, bt_cols)
+    ras_processor.qc_check2(ras_bt_rows, ras_bt_cols, ras_mat)
+    ras_processor.qc_check3(bt_rows, extant_matrix)
+    ras_processor.qc_check4(bt_cols, extant_matrix)
+    timings['qc'] = time.perf_counter() - start
+    qc_errors = [check.get('error') for check in (ras_processor._qc_extant, ras_processor._qc_check0, ras_processor._qc_check1,
+                                                 ras_processor._qc_check2, ras_processor._qc_check3, ras_processor._qc_check4) if check.get('error')]
+
+    # perform_ras ends with the write-back, which is timed on its own
+    save_balanced = ras_processor.save_balanced
+    def timed_save_balanced(*args, **kwargs):
+        start = time.perf_counter()
+        result = save_balanced(*args, **kwargs)
+        timings['write_back'] = time.perf_counter() - start
+        return result
+    ras_processor.save_balanced = timed_save_balanced
+
+    start = time.perf_counter()
+    ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols, max_iterations, epsilon, scheme=scheme)
+    timings['iterations'] = time.perf_counter() - start - timings['write_back']
+    timings['total'] = sum(timings.values())
+
+    ras_processor.db_session.remove()
+    return {
+        'timings': timings,
+        'iterations': len(ras_processor.residual_trace),
+        'final_row_error': float(ras_processor.residual_trace[-1][0]),
+        'final_col_error': float(ras_processor.residual_trace[-1][1]),
+        'sparse': bool(ras_processor.use_sparse),
+        'qc_errors': qc_errors,
+    }
+
+# the commit being benchmarked, if this is a git checkout
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_size(size):
+    rows, cols = size.lower().split('x')
+    return int(rows), int(cols)
+
+def main():
+    parser = argparse.ArgumentParser(description='This script benchmarks RAS on synthetic jobs stored in a local SQLite database and writes the timings of every phase as json.')
+    parser.add_argument('--sizes', nargs='+', default=['100x100', '409x409'], help='Matrix sizes as ROWSxCOLS. The default is 100x100 409x409.')
+    parser.add_argument('--densities', type=float, nargs='+', default=[1.0], help='Shares of non-zero cells. The default is 1.')
+    parser.add_argument('--negative_shares', type=float, nargs='+', default=[0.01], help='Shares of non-zero cells that are negative. The default is 0.01.')
+    parser.add_argument('--frozen_shares', type=float, nargs='+', default=[0.01], help='Shares of cells with an ad-hoc freeze value. The default is 0.01.')
+    parser.add_argument('--schemes', nargs='+', choices=RAS_SCHEMES, default=['simultaneous'], help='RAS update schemes to benchmark. The default is simultaneous.')
+    parser.add_argument('--iterations', '-i', type=int, default=1000, help='The max iterations for RAS. The default value is 1000.')
+    parser.add_argument('--epsilon', '-e', type=float, default=0.00001, help='Error threshold for the RAS algorithm. The default value is 0.00001.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times every job is run. The default is 1.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic jobs.')
+    parser.add_argument('--database', help='SQLite file to build the jobs in. The default is a temporary file that is removed afterwards.')
+    parser.add_argument('--output', '-o', help='File to write the json results to. The default is to print them.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_uri = 'sqlite:///{0}'.format(args.database or os.path.join(tmp_dir, 'ras_benchmark.sqlite'))
+        # the ras schema doesn't exist in SQLite, so the tables are created in the main database
+        engine = create_ras_engine(database_uri).execution_options(schema_translate_map={'ras': None})
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+
+        runs = []
+        job_id = 0
+        for size, density, negative_share, frozen_share in product(args.sizes, args.densities, args.negative_shares, args.frozen_shares):
+            rows, cols = parse_size(size)
+            for scheme in args.schemes:
+                for repeat in range(args.repeat):
+                    job_id += 1
+                    create_job(engine, job_id, rows, cols, density, negative_share, frozen_share, args.seed)
+                    result = benchmark_job(engine, database_uri, job_id, args.iterations, args.epsilon, scheme)
+                    result.update({'rows': rows, 'cols': cols, 'density': density, 'negative_share': negative_share,
+                                   'frozen_share': frozen_share, 'scheme': scheme, 'repeat': repeat})
+                    runs.append(result)
+                    print('{0} density {1} {2}: {3:.3f} seconds'.format(size, density, scheme, result['timings']['total']))
+        engine.dispose()
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'max_iterations': args.iterations,
+        'epsilon': args.epsilon,
+        'runs': runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+# only run the program if this file is called directly
+if __name__ == '__main__':
+    main()
@@ -6,23 +6,174 @@ Created on Thu May  4 10:04:35 2023
  
 """
 
-import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
+from scipy import sparse
+from sqlalchemy import create_engine, select, update, insert, delete
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, scoped_session
 from decouple import Config, RepositoryEnv
-from ras_models import ExtantMatrix, ExtantRows, ExtantColumns, JobProperties 
+from ras_models import ExtantMatrix, ExtantRows, ExtantColumns, JobProperties, RASMultipliers, RASResiduals
 import csv
 import os
 
+# RAS update schemes:
+#     simultaneous - row and column multipliers from the same sums, applied together
+#     alternating  - classic RAS: scale the rows to their totals, then the columns
+#     accelerated  - alternating, with the multipliers extrapolated (raised to the power omega > 1);
+#                    the extrapolation is halved whenever the error grows
+RAS_SCHEMES = ['simultaneous', 'alternating', 'accelerated']
+
+# create an engine for the RAS database
+def create_ras_engine(database_uri, **options):
+    # let psycopg2 send the bulk updates of save_results() in pages instead of one statement per row
+    if make_url(database_uri).drivername in ('postgresql', 'postgresql+psycopg2'):
+        options.setdefault('executemany_mode', 'values_plus_batch')
+    return create_engine(database_uri, echo=False, **options)
+
+# row (axis=1) or column (axis=0) sums of a dense or sparse matrix as a 1-D array
+def matrix_sums(mat, axis):
+    return np.asarray(mat.sum(axis=axis, dtype=float)).ravel()
+
+# the stored values of a dense or sparse matrix
+def matrix_values(mat):
+    return mat.data if sparse.issparse(mat) else mat
+
+# the amt_after_ras and amt_frozen values of cells, given their balanced and frozen values and their
+# ad-hoc freeze values (nan when the cell has none). cells frozen ad-hoc were zero during RAS and take
+# their ad-hoc value
+def apply_adhoc_freeze(new_values, frozen_values, adhoc):
+    adhoc_frozen = (np.nan_to_num(adhoc) != 0) & (new_values == 0)
+    amt_after_ras = np.where(adhoc_frozen, adhoc, new_values)
+    amt_frozen = np.where(adhoc_frozen, adhoc, frozen_values)
+    return amt_after_ras, amt_frozen
+
+# balance a stack of same-shaped matrices (batch x rows x cols) to their border totals (batch x rows and
+# batch x cols) with the same updates as RASProcessor.perform_ras, iterating every member together.
+# a member stops updating as soon as it has converged; epsilon can be one value or one value per member.
+# row_multipliers and col_multipliers (batch x rows and batch x cols) optionally warm start the members.
+# returns the balanced stack, the total row and column multipliers, the final row error, column error
+# and iteration of every member, and the residual trace of every member (an iterations x 2 array of the
+# row and column error after each iteration)
+def batch_ras(mats, bt_rows, bt_cols, max_iterations=1000, epsilon=0.00001, row_multipliers=None, col_multipliers=None, scheme='simultaneous', omega=1.5):
+    if scheme not in RAS_SCHEMES:
+        raise ValueError('unknown RAS scheme: {0}'.format(scheme))
+    result = np.array(mats, dtype=float)
+    batch_n, row_n, col_n = result.shape
+    bt_rows = np.asarray(bt_rows, dtype=float).reshape(batch_n, row_n)
+    bt_cols = np.asarray(bt_cols, dtype=float).reshape(batch_n, col_n)
+    epsilon = np.broadcast_to(np.asarray(epsilon, dtype=float), (batch_n,))
+    row_mult = np.ones((batch_n, row_n)) if row_multipliers is None else np.array(row_multipliers, dtype=float)
+    col_mult = np.ones((batch_n, col_n)) if col_multipliers is None else np.array(col_multipliers, dtype=float)
+    result *= row_mult[:, :, None] * col_mult[:, None, :]
+    row_error = np.zeros(batch_n)
+    col_error = np.zeros(batch_n)
+    iterations = np.zeros(batch_n, dtype=int)
+    trace_members, trace_row_error, trace_col_error = [np.zeros(0, dtype=int)], [np.zeros(0)], [np.zeros(0)]
+
+    # the members that haven't converged yet; their data are kept in compact working arrays
+    # that shrink whenever members converge
+    active = np.arange(batch_n)
+    work, work_rows, work_cols, work_eps = result, bt_rows, bt_cols, epsilon
+    work_row_mult, work_col_mult = row_mult, col_mult
+    work_omega = np.full(batch_n, omega if scheme == 'accelerated' else 1.0)
+    work_previous_error = np.full(batch_n, np.inf)
+    R = np.zeros((batch_n, row_n))
+    S = np.zeros((batch_n, col_n))
+    row_sums = work.sum(axis=2)
+    col_sums = work.sum(axis=1)
+    for iteration in range(max_iterations):
+        # mask out zeros; the multipliers of empty rows and columns keep their last value, as in perform_ras
+        non_zero_rows = row_sums > 0
+        if scheme == 'simultaneous':
+            non_zero_cols = col_sums > 0
+            R[non_zero_rows] = work_rows[non_zero_rows] / row_sums[non_zero_rows]
+            S[non_zero_cols] = work_cols[non_zero_cols] / col_sums[non_zero_cols]
+            work_row_mult[non_zero_rows] *= R[non_zero_rows]
+            work_col_mult[non_zero_cols] *= S[non_zero_cols]
+            work *= R[:, :, None] * S[:, None, :]
+            row_sums = work.sum(axis=2)
+            col_sums = work.sum(axis=1)
+        else:
+            # rows first, then the columns of the row-scaled matrix
+            exponent = np.broadcast_to(work_omega[:, None], row_sums.shape)
+            R[non_zero_rows] = (work_rows[non_zero_rows] / row_sums[non_zero_rows]) ** exponent[non_zero_rows]
+            work_row_mult[non_zero_rows] *= R[non_zero_rows]
+            work *= R[:, :, None]
+            col_sums = work.sum(axis=1)
+            non_zero_cols = col_sums > 0
+            exponent = np.broadcast_to(work_omega[:, None], col_sums.shape)
+            S[non_zero_cols] = (work_cols[non_zero_cols] / col_sums[non_zero_cols]) ** exponent[non_zero_cols]
+            work_col_mult[non_zero_cols] *= S[non_zero_cols]
+            work *= S[:, None, :]
+            row_sums = work.sum(axis=2)
+            # scaling a column scales its sum
+            col_sums = np.where(non_zero_cols, col_sums * S, col_sums)
+
+        work_row_error = np.max(np.abs(work_rows - row_sums), axis=1)
+        work_col_error = np.max(np.abs(work_cols - col_sums), axis=1)
+        trace_members.append(active)
+        trace_row_error.append(work_row_error)
+        trace_col_error.append(work_col_error)
+        if scheme == 'accelerated':
+            # halve the extrapolation of members whose error grew
+            work_error = np.maximum(work_row_error, work_col_error)
+            worse = work_error > work_previous_error
+            work_omega[worse] = 1 + (work_omega[worse] - 1) / 2
+            work_previous_error = work_error
+        done = (work_row_error < work_eps) & (work_col_error < work_eps)
+        if iteration == max_iterations - 1:
+            done[:] = True
+        if not done.any():
+            continue
+
+        # store the converged members and drop them from the working arrays
+        members = active[done]
+        result[members] = work[done]
+        row_mult[members] = work_row_mult[done]
+        col_mult[members] = work_col_mult[done]
+        row_error[members] = work_row_error[done]
+        col_error[members] = work_col_error[done]
+        iterations[members] = iteration
+        keep = ~done
+        if not keep.any():
+            break
+        active = active[keep]
+        work, work_rows, work_cols, work_eps = work[keep], work_rows[keep], work_cols[keep], work_eps[keep]
+        work_row_mult, work_col_mult = work_row_mult[keep], work_col_mult[keep]
+        work_omega, work_previous_error = work_omega[keep], work_previous_error[keep]
+        R, S, row_sums, col_sums = R[keep], S[keep], row_sums[keep], col_sums[keep]
+
+    # split the per-iteration errors by member, keeping the iteration order
+    members = np.concatenate(trace_members)
+    order = np.argsort(members, kind='stable')
+    splits = np.cumsum(np.bincount(members, minlength=batch_n))[:-1]
+    row_traces = np.split(np.concatenate(trace_row_error)[order], splits)
+    col_traces = np.split(np.concatenate(trace_col_error)[order], splits)
+    traces = [np.column_stack((row_trace, col_trace)) for row_trace, col_trace in zip(row_traces, col_traces)]
+    return result, row_mult, col_mult, row_error, col_error, iterations, traces
+
 class RASProcessor:
-    def __init__(self, database_uri, job_id):
+    # jobs with at least sparse_min_cells cells and no more than sparse_max_density non-zero cells
+    # are balanced as sparse (CSR) matrices, so each iteration only touches the non-zero cells
+    sparse_min_cells = 250000
+    sparse_max_density = 0.1
+
+    # engine is optional; processes that run many jobs pass a shared engine (see create_ras_engine)
+    # so that every job reuses the same connection pool.
+    # with warm_start, jobs that name an earlier job are warm started from its multipliers and every job's
+    # final multipliers are saved (needs the tables and columns in sql/warm_start.sql)
+    # with keep_trace, the RAS scheme and residual trace of every job are saved (needs the table and column
+    # in sql/residual_trace.sql)
+    def __init__(self, database_uri, job_id, engine=None, warm_start=False, keep_trace=False):
         self.database_uri = database_uri
-        self._create_session()
+        self._create_session(engine)
         self.job_id = job_id
+        self.warm_start = warm_start
+        self.keep_trace = keep_trace
 
-    def _create_session(self):
-        engine = create_engine(self.database_uri, echo=False)
+    def _create_session(self, engine=None):
+        if engine is None:
+            engine = create_ras_engine(self.database_uri)
         session_factory = sessionmaker(bind=engine)
         self.db_session = scoped_session(session_factory)
 
@@ -31,15 +182,81 @@ class RASProcessor:
         return query
 
     def get_extant_matrix(self, job_id):
-        query = self.db_session.query(ExtantMatrix.row_id, ExtantMatrix.col_id, ExtantMatrix.amt_original, ExtantMatrix.amt_to_freeze_adhoc).filter(ExtantMatrix.ras_id == self.job_id).all()
-        df = pd.DataFrame(query, columns=['row_id', 'col_id', 'matrix', 'amt_to_freeze'])
-        for i in range(0, len(df)):
-            if pd.notna(df['amt_to_freeze'][i]):
-                df.loc[i, 'matrix'] = 0
-        df = df.pivot_table(values='matrix', index='row_id', columns='col_id')
-        ex_matrix = df.to_numpy()
+        query = self.db_session.execute(select(ExtantMatrix.row_id, ExtantMatrix.col_id, ExtantMatrix.amt_original, ExtantMatrix.amt_to_freeze_adhoc).where(ExtantMatrix.ras_id == self.job_id)).all()
+        # NULL values become nan
+        cells = np.array([tuple(row) for row in query], dtype=float).reshape(-1, 4)
+        return self.build_extant_matrix(cells[:, 0], cells[:, 1], cells[:, 2], cells[:, 3])
+
+    # build the extant matrix from its cells, scattering them straight into a (row x col) array
+    # the rows and columns are the sorted row and column ids of the job (kept in self.row_ids and self.col_ids).
+    # large matrices that are mostly zero are returned as a scipy CSR matrix (self.use_sparse is set to True).
+    # cells with an ad-hoc freeze value (not nan) enter RAS as zero; they are marked in self.adhoc_mask.
+    # duplicate, missing and empty cells are reported in self._qc_extant
+    def build_extant_matrix(self, row_id, col_id, amt_original, amt_to_freeze_adhoc):
+        self.row_ids, row_pos = np.unique(np.asarray(row_id).astype(np.int64), return_inverse=True)
+        self.col_ids, col_pos = np.unique(np.asarray(col_id).astype(np.int64), return_inverse=True)
+        shape = (len(self.row_ids), len(self.col_ids))
+        adhoc = ~np.isnan(np.asarray(amt_to_freeze_adhoc, dtype=float))
+        values = np.where(adhoc, 0, np.asarray(amt_original, dtype=float))
+        empty = np.isnan(values)
+        values[empty] = 0
+
+        # check that every cell appears exactly once
+        flat, counts = np.unique(row_pos * shape[1] + col_pos, return_counts=True)
+        self._qc_extant = {'success': 'extant matrix has exactly one value for every cell'}
+        missing = shape[0] * shape[1] - len(flat)
+        if missing > 0:
+            # the first flat position that doesn't match its index is the first missing cell
+            first = np.argmax(np.append(flat != np.arange(len(flat)), True))
+            self._qc_extant = {'error': 'extant matrix has {0} missing cells, first at row_id {1}, col_id {2}'.format(missing, self.row_ids[first // shape[1]], self.col_ids[first % shape[1]])}
+        elif np.any(counts > 1):
+            first = flat[np.argmax(counts > 1)]
+            self._qc_extant = {'error': 'extant matrix has {0} duplicate cells, first at row_id {1}, col_id {2}'.format(np.sum(counts > 1), self.row_ids[first // shape[1]], self.col_ids[first % shape[1]])}
+        elif np.any(empty):
+            first = np.argmax(empty)
+            self._qc_extant = {'error': 'extant matrix has {0} empty (NULL) cells, first at row_id {1}, col_id {2}'.format(np.sum(empty), self.row_ids[row_pos[first]], self.col_ids[col_pos[first]])}
+
+        non_zero = values != 0
+        self.use_sparse = self.prefers_sparse(shape, np.sum(non_zero))
+        if self.use_sparse:
+            ex_matrix = sparse.csr_matrix((values[non_zero], (row_pos[non_zero], col_pos[non_zero])), shape=shape)
+            self.adhoc_mask = sparse.csr_matrix((np.ones(np.sum(adhoc), dtype=bool), (row_pos[adhoc], col_pos[adhoc])), shape=shape)
+        else:
+            ex_matrix = np.zeros(shape)
+            ex_matrix[row_pos, col_pos] = values
+            self.adhoc_mask = np.zeros(shape, dtype=bool)
+            self.adhoc_mask[row_pos, col_pos] = adhoc
         return ex_matrix
 
+    # True if a matrix of this shape and number of non-zero cells should be balanced as a sparse matrix
+    def prefers_sparse(self, shape, non_zero_count):
+        return shape[0] * shape[1] >= self.sparse_min_cells and non_zero_count <= self.sparse_max_density * shape[0] * shape[1]
+
+    # the final row and column multipliers of the job this job is warm started from (JobProperties.warm_start_job_id)
+    # the multipliers are lined up with this job's rows and columns (call after get_extant_matrix); rows and
+    # columns the earlier job doesn't have start from 1. returns None, None when the job isn't warm started
+    def get_warm_start_multipliers(self, job_id):
+        if not self.warm_start:
+            return None, None
+        warm_start_job_id = self.db_session.scalar(select(JobProperties.warm_start_job_id).where(JobProperties.id == self.job_id))
+        if warm_start_job_id is None:
+            return None, None
+        query = self.db_session.execute(select(RASMultipliers.axis, RASMultipliers.position_id, RASMultipliers.multiplier).where(RASMultipliers.ras_id == warm_start_job_id)).all()
+        multipliers = {'row': {}, 'col': {}}
+        for axis, position_id, multiplier in query:
+            multipliers[axis][position_id] = multiplier
+        return self.align_multipliers(multipliers)
+
+    # line up multipliers given as {'row': {row_id: multiplier}, 'col': {col_id: multiplier}} with this job's
+    # rows and columns
+    def align_multipliers(self, multipliers):
+        row_multipliers = np.array([multipliers['row'].get(row_id, 1.0) for row_id in self.row_ids.tolist()], dtype=float)
+        col_multipliers = np.array([multipliers['col'].get(col_id, 1.0) for col_id in self.col_ids.tolist()], dtype=float)
+        # a zero multiplier would empty a row or column for good, so those start from 1 as well
+        row_multipliers[~(np.isfinite(row_multipliers) & (row_multipliers > 0))] = 1
+        col_multipliers[~(np.isfinite(col_multipliers) & (col_multipliers > 0))] = 1
+        return row_multipliers, col_multipliers
+
     def get_bt_rows(self, job_id):
         query = self.db_session.query(ExtantRows.amt_original).filter(ExtantRows.ras_id == self.job_id).order_by(ExtantRows.row_id).all()
         bt_row_totals = np.array(query).flatten()
@@ -51,8 +268,18 @@ class RASProcessor:
         return bt_col_totals
 
     def freeze_negatives(self, bt_rows, bt_cols, extant_mat):
-        ras_matrix = np.copy(extant_mat)
-        ras_matrix[ras_matrix < 0] = 0
+        if sparse.issparse(extant_mat):
+            ras_matrix = extant_mat.copy()
+            ras_matrix.data[ras_matrix.data < 0] = 0
+            ras_matrix.eliminate_zeros()
+            neg_values_matrix = extant_mat.copy()
+            neg_values_matrix.data[neg_values_matrix.data >= 0] = 0
+            neg_values_matrix.eliminate_zeros()
+        else:
+            ras_matrix = np.copy(extant_mat)
+            ras_matrix[ras_matrix < 0] = 0
+            neg_values_matrix = np.copy(extant_mat)
+            neg_values_matrix[neg_values_matrix >= 0] = 0
 
         ras_bt_rows = np.copy(bt_rows)
         ras_bt_rows[ras_bt_rows < 0] = 0
@@ -60,9 +287,6 @@ class RASProcessor:
         ras_bt_cols = np.copy(bt_cols)
         ras_bt_cols[ras_bt_cols < 0] = 0
 
-        neg_values_matrix = np.copy(extant_mat)
-        neg_values_matrix[neg_values_matrix >= 0] = 0
-
         neg_values_bt_rows = np.copy(bt_rows)
         neg_values_bt_rows[neg_values_bt_rows >= 0] = 0
 
@@ -89,11 +313,11 @@ class RASProcessor:
     def qc_check2(self, ras_row_bt, ras_col_bt, ras_mat):
         row_mask = ras_row_bt < 0
         col_mask = ras_col_bt < 0
-        ras_mask = ras_mat < 0
+        ras_mask = matrix_values(ras_mat) < 0
 
         negative_row = ras_row_bt[row_mask]
         negative_col = ras_col_bt[col_mask]
-        negative_mat = ras_mat[ras_mask]
+        negative_mat = matrix_values(ras_mat)[ras_mask]
 
         if len(negative_row) > 0:
             self._qc_check2 = {'error': 'row border total includes negative values'}
@@ -104,116 +328,198 @@ class RASProcessor:
         self._qc_check2 = {'success': 'input data do not contain negative values'}
 
     def qc_check3(self, row_bt, extant_mat):
-        qc_row_sums = np.sum(extant_mat, axis=1)
+        qc_row_sums = matrix_sums(extant_mat, axis=1)
         if len(row_bt) != len(qc_row_sums):
             self._qc_check3 = {'error': 'matrix row count != border total row count'}
-        for i in range(0, len(qc_row_sums)):
-            if qc_row_sums[i] > 0 and row_bt[i] == 0:
-                self._qc_check3 = {'error': 'row border total == 0 and matrix row sum > 0'}
-        self._qc_check3 = {'success': 'matrix rows and border total rows consistent'}
+        elif np.any((qc_row_sums > 0) & (row_bt == 0)):
+            self._qc_check3 = {'error': 'row border total == 0 and matrix row sum > 0'}
+        else:
+            self._qc_check3 = {'success': 'matrix rows and border total rows consistent'}
 
     def qc_check4(self, col_bt, extant_mat):
-        qc_col_sums = np.sum(extant_mat, axis=0)
+        qc_col_sums = matrix_sums(extant_mat, axis=0)
         if len(col_bt) != len(qc_col_sums):
             self._qc_check4 = {'error': 'matrix col count != border total col count'}
-        for i in range(0, len(qc_col_sums)):
-            if qc_col_sums[i] > 0 and col_bt[i] == 0:
-                self._qc_check4 = {'error': 'col border total == 0 and matrix col sum > 0'}
-        self._qc_check4 = {'success': 'matrix cols and border total cols consistent'}
+        elif np.any((qc_col_sums > 0) & (col_bt == 0)):
+            self._qc_check4 = {'error': 'col border total == 0 and matrix col sum > 0'}
+        else:
+            self._qc_check4 = {'success': 'matrix cols and border total cols consistent'}
+
+    def start_job(self):
+        job = self.db_session.query(JobProperties).filter(JobProperties.id == self.job_id).first()
+        job.status = 'running'
+        self.db_session.commit()
 
     def finish_job_error(self):
         job = self.db_session.query(JobProperties).filter(JobProperties.id == self.job_id).first()
         job.status = 'error'
         self.db_session.commit()
 
-    def perform_ras(self, bt_row_totals, bt_col_totals, mat_data, frozen_mat, original_mat, frozen_bt_rows, frozen_bt_cols, max_iterations=1000, epsilon=0.00001):
-        result_array = np.copy(mat_data)
+    # balance the matrix to the border totals
+    # mat_data can be a dense array or a scipy sparse matrix; a sparse matrix is scaled by updating
+    # only its stored non-zero values, which gives the same result as the dense update.
+    # row_multipliers and col_multipliers optionally warm start the balancing (see get_warm_start_multipliers).
+    # scheme is one of RAS_SCHEMES; omega is the extrapolation of the accelerated scheme.
+    # the total multipliers of the result are kept in self.row_multipliers and self.col_multipliers,
+    # and the row and column error after every iteration in self.residual_trace
+    def perform_ras(self, bt_row_totals, bt_col_totals, mat_data, frozen_mat, original_mat, frozen_bt_rows, frozen_bt_cols, max_iterations=1000, epsilon=0.00001, row_multipliers=None, col_multipliers=None, scheme='simultaneous', omega=1.5):
+        if scheme not in RAS_SCHEMES:
+            raise ValueError('unknown RAS scheme: {0}'.format(scheme))
+        is_sparse = sparse.issparse(mat_data)
+        if is_sparse:
+            result_array = sparse.csr_matrix(mat_data, dtype=float, copy=True)
+            # the row of every stored value
+            value_rows = np.repeat(np.arange(result_array.shape[0]), np.diff(result_array.indptr))
+        else:
+            result_array = np.copy(mat_data)
         row_n = result_array.shape[0]
         col_n = result_array.shape[1]
         success_message = {'success': 'RAS completed, max iterations reached'}
         R = np.zeros(row_n, dtype=float)
         S = np.zeros(col_n, dtype=float)
+        # the result is diag(row_multipliers) * mat_data * diag(col_multipliers)
+        row_multipliers = np.ones(row_n) if row_multipliers is None else np.array(row_multipliers, dtype=float)
+        col_multipliers = np.ones(col_n) if col_multipliers is None else np.array(col_multipliers, dtype=float)
+        if is_sparse:
+            result_array.data *= row_multipliers[value_rows] * col_multipliers[result_array.indices]
+        else:
+            result_array *= np.outer(row_multipliers, col_multipliers)
+
+        # scale the rows and/or columns; a sparse matrix only scales its stored values
+        def scale(row_factors=None, col_factors=None):
+            if is_sparse:
+                if row_factors is not None:
+                    result_array.data *= row_factors[value_rows]
+                if col_factors is not None:
+                    result_array.data *= col_factors[result_array.indices]
+            elif row_factors is not None and col_factors is not None:
+                result_array[...] *= np.outer(row_factors, col_factors)
+            elif row_factors is not None:
+                result_array[...] *= row_factors[:, None]
+            else:
+                result_array[...] *= col_factors
+
+        def sums(axis):
+            if is_sparse:
+                return np.bincount(value_rows if axis == 1 else result_array.indices, weights=result_array.data, minlength=row_n if axis == 1 else col_n)
+            return np.sum(result_array, axis=axis, dtype=float)
+
+        # the sums after one iteration are the sums the next iteration starts from
+        row_sums_final = matrix_sums(result_array, axis=1)
+        col_sums_final = matrix_sums(result_array, axis=0)
+        omega = omega if scheme == 'accelerated' else 1.0
+        previous_error = np.inf
+        # row and column error after every iteration
+        self.residual_trace = []
         for iteration in range(max_iterations):
-            row_sums = np.sum(result_array, axis=1, dtype=float)
-            col_sums = np.sum(result_array, axis=0, dtype=float)
+            row_sums = row_sums_final
+            col_sums = col_sums_final
        
             # mask out zeros
             non_zero_rows = row_sums > 0
-            non_zero_cols = col_sums > 0 
-            # row and column multipliers for non-zero values, otherwise the scaler is 1
-            R[non_zero_rows] = bt_row_totals[non_zero_rows] / row_sums[non_zero_rows]
-            S[non_zero_cols] = bt_col_totals[non_zero_cols] / col_sums[non_zero_cols]
-            
-            result_array *= np.outer(R, S)
-
-            row_sums_final = np.sum(result_array, axis=1, dtype=float)
-            col_sums_final = np.sum(result_array, axis=0, dtype=float)
+            if scheme == 'simultaneous':
+                non_zero_cols = col_sums > 0 
+                # row and column multipliers for non-zero values, otherwise the scaler is 1
+                R[non_zero_rows] = bt_row_totals[non_zero_rows] / row_sums[non_zero_rows]
+                S[non_zero_cols] = bt_col_totals[non_zero_cols] / col_sums[non_zero_cols]
+                scale(R, S)
+                col_sums_final = sums(axis=0)
+            else:
+                # rows first, then the columns of the row-scaled matrix
+                R[non_zero_rows] = (bt_row_totals[non_zero_rows] / row_sums[non_zero_rows]) ** omega
+                scale(row_factors=R)
+                col_sums = sums(axis=0)
+                non_zero_cols = col_sums > 0
+                S[non_zero_cols] = (bt_col_totals[non_zero_cols] / col_sums[non_zero_cols]) ** omega
+                scale(col_factors=S)
+                # scaling a column scales its sum
+                col_sums_final = np.where(non_zero_cols, col_sums * S, col_sums)
+            # rows and columns that sum to zero are all zero, so their multipliers don't change them
+            row_multipliers[non_zero_rows] *= R[non_zero_rows]
+            col_multipliers[non_zero_cols] *= S[non_zero_cols]
+            row_sums_final = sums(axis=1)
+
             row_error = np.max(np.abs(bt_row_totals - row_sums_final))
             col_error = np.max(np.abs(bt_col_totals - col_sums_final))
+            self.residual_trace.append((row_error, col_error))
             if row_error < epsilon and col_error < epsilon:
                 success_message['success'] = 'RAS completed, threshold reached at {0} iterations'.format(iteration)
                 break
-        # pull row and column bt totals to update
-        db_row_record = self.db_session.query(ExtantRows).filter_by(ras_id=self.job_id).order_by(ExtantRows.row_id)
-        row_index = 0
-        bt_row_final = np.add(frozen_bt_rows, row_sums_final)
-        for row_record in db_row_record:
-            row_record.amt_after_ras = bt_row_final[row_index]
-            row_index += 1
-
-        db_col_record = self.db_session.query(ExtantColumns).filter_by(ras_id=self.job_id).order_by(ExtantColumns.col_id)
-        col_index = 0
-        bt_col_final = np.add(frozen_bt_cols, col_sums_final)
-        for col_record in db_col_record:
-            col_record.amt_after_ras = bt_col_final[col_index]
-            col_index += 1
+            if scheme == 'accelerated' and max(row_error, col_error) > previous_error:
+                # the extrapolation overshot, halve it
+                omega = 1 + (omega - 1) / 2
+            previous_error = max(row_error, col_error)
+        return self.save_balanced(result_array, frozen_mat, frozen_bt_rows, frozen_bt_cols, row_multipliers, col_multipliers, row_error, col_error, iteration, self.residual_trace, scheme)
 
+    # add the frozen values back to a balanced matrix and save it with its multipliers and residual trace
+    # returns the final matrix
+    def save_balanced(self, result_array, frozen_mat, frozen_bt_rows, frozen_bt_cols, row_multipliers, col_multipliers, row_error, col_error, iteration, residual_trace=None, scheme='simultaneous'):
+        bt_row_final = np.add(frozen_bt_rows, matrix_sums(result_array, axis=1))
+        bt_col_final = np.add(frozen_bt_cols, matrix_sums(result_array, axis=0))
         # create add balanced matrix to the frozen values
-        final_out = np.add(result_array, frozen_mat)
-        original_df = pd.DataFrame(original_mat)
-        original_df['row_id'] = original_df.index + 1
-        original_df = original_df.melt(id_vars='row_id', var_name='col_id', value_name='amt_original')
-        original_df['col_id'] = original_df['col_id'] + 1
-
-        output_df = pd.DataFrame(final_out)
-        output_df['row_id'] = output_df.index + 1
-        output_df = output_df.melt(id_vars='row_id', var_name='col_id', value_name='amt_after_ras')
-        output_df['col_id'] = output_df['col_id'] + 1 
-
-        frozen_df = pd.DataFrame(frozen_mat)
-        frozen_df['row_id'] = frozen_df.index + 1
-        frozen_df = frozen_df.melt(id_vars='row_id', var_name='col_id', value_name='amt_frozen')
-        frozen_df['col_id'] = frozen_df['col_id'] + 1
-
-        final_df = pd.merge(original_df, output_df, how='inner',
-                    left_on=['row_id', 'col_id'],
-                    right_on=['row_id', 'col_id'])
-        final_df = pd.merge(final_df, frozen_df, how='inner',
-                    left_on=['row_id', 'col_id'],
-                    right_on=['row_id', 'col_id'])
-        for index, row in final_df.iterrows():
-            row_id = row['row_id']
-            col_id = row['col_id']
-            matrix_value = row['amt_original']
-            new_matrix_value = row['amt_after_ras']
-            frozen_val = row['amt_frozen']
-            db_record = self.db_session.query(ExtantMatrix).filter_by(row_id=row_id, col_id=col_id, ras_id=self.job_id).first()
-            # given all of the qc checks, this condition should never evaluate to false
-            if db_record:
-                # matrix data is frozen in the get_extant_matrix() function.
-                # Here we ensure that the val was frozen, and updated the amt_frozen and the amt_after_ras value
-                if db_record.amt_to_freeze_adhoc and new_matrix_value == 0:
-                    db_record.amt_after_ras = db_record.amt_to_freeze_adhoc
-                    db_record.amt_frozen = db_record.amt_to_freeze_adhoc
-                else:
-                    db_record.amt_after_ras = new_matrix_value
-                    db_record.amt_frozen = frozen_val
-            else:
-                continue  
+        final_out = result_array + frozen_mat if sparse.issparse(result_array) else np.add(result_array, frozen_mat)
+        self.row_multipliers = row_multipliers
+        self.col_multipliers = col_multipliers
+        if self.warm_start:
+            self.save_multipliers(row_multipliers, col_multipliers)
+        if self.keep_trace and residual_trace is not None:
+            self.save_residual_trace(residual_trace)
+        self.save_results(final_out, frozen_mat, bt_row_final, bt_col_final, row_error, col_error, iteration, scheme)
+        return final_out
+
+    # store the row and column error after every iteration (committed together with the results by save_results)
+    def save_residual_trace(self, residual_trace):
+        self.db_session.execute(delete(RASResiduals).where(RASResiduals.ras_id == self.job_id))
+        mappings = [{'ras_id': self.job_id, 'iteration': iteration, 'row_error': row_error, 'col_error': col_error}
+                    for iteration, (row_error, col_error) in enumerate(np.asarray(residual_trace, dtype=float).reshape(-1, 2).tolist())]
+        if mappings:
+            self.db_session.execute(insert(RASResiduals), mappings)
+
+    # store the total row and column multipliers of the job, so later jobs can be warm started from them
+    # (committed together with the results by save_results)
+    def save_multipliers(self, row_multipliers, col_multipliers):
+        row_ids = self.db_session.scalars(select(ExtantRows.row_id).where(ExtantRows.ras_id == self.job_id).order_by(ExtantRows.row_id)).all()
+        col_ids = self.db_session.scalars(select(ExtantColumns.col_id).where(ExtantColumns.ras_id == self.job_id).order_by(ExtantColumns.col_id)).all()
+        self.db_session.execute(delete(RASMultipliers).where(RASMultipliers.ras_id == self.job_id))
+        mappings = [{'ras_id': self.job_id, 'axis': 'row', 'position_id': row_id, 'multiplier': value} for row_id, value in zip(row_ids, row_multipliers.tolist())]
+        mappings += [{'ras_id': self.job_id, 'axis': 'col', 'position_id': col_id, 'multiplier': value} for col_id, value in zip(col_ids, col_multipliers.tolist())]
+        self.db_session.execute(insert(RASMultipliers), mappings)
+
+    # write the balanced matrix, border totals and job status back to the database
+    # every table is updated with one bulk statement keyed on the primary key instead of a query per cell
+    def save_results(self, final_out, frozen_mat, bt_row_final, bt_col_final, row_error, col_error, iteration, scheme='simultaneous'):
+        cells = self.db_session.execute(select(ExtantMatrix.id, ExtantMatrix.row_id, ExtantMatrix.col_id, ExtantMatrix.amt_to_freeze_adhoc).where(ExtantMatrix.ras_id == self.job_id)).all()
+        # NULL ad-hoc values become nan
+        cells = np.array([tuple(row) for row in cells], dtype=float).reshape(-1, 4)
+        ids = cells[:, 0].astype(np.int64)
+        # the matrix rows and columns are the sorted row and column ids (see get_extant_matrix)
+        row_pos = np.searchsorted(np.unique(cells[:, 1]), cells[:, 1])
+        col_pos = np.searchsorted(np.unique(cells[:, 2]), cells[:, 2])
+        new_values = np.asarray(final_out[row_pos, col_pos], dtype=float).ravel()
+        frozen_values = np.asarray(frozen_mat[row_pos, col_pos], dtype=float).ravel()
+        # matrix data is frozen in the get_extant_matrix() function.
+        # Here we ensure that the val was frozen, and updated the amt_frozen and the amt_after_ras value
+        amt_after_ras, amt_frozen = apply_adhoc_freeze(new_values, frozen_values, cells[:, 3])
+        self.db_session.execute(update(ExtantMatrix), [
+            {'id': cell_id, 'amt_after_ras': after, 'amt_frozen': frozen}
+            for cell_id, after, frozen in zip(ids.tolist(), amt_after_ras.tolist(), amt_frozen.tolist())
+        ])
+
+        # border totals are matched to the results by their order
+        row_ids = self.db_session.scalars(select(ExtantRows.id).where(ExtantRows.ras_id == self.job_id).order_by(ExtantRows.row_id)).all()
+        self.db_session.execute(update(ExtantRows), [
+            {'id': record_id, 'amt_after_ras': value} for record_id, value in zip(row_ids, np.asarray(bt_row_final, dtype=float).tolist())
+        ])
+        col_ids = self.db_session.scalars(select(ExtantColumns.id).where(ExtantColumns.ras_id == self.job_id).order_by(ExtantColumns.col_id)).all()
+        self.db_session.execute(update(ExtantColumns), [
+            {'id': record_id, 'amt_after_ras': value} for record_id, value in zip(col_ids, np.asarray(bt_col_final, dtype=float).tolist())
+        ])
+
         job = self.db_session.query(JobProperties).filter(JobProperties.id == self.job_id).first()
         job.status = 'completed'
-        job.final_row_tolerance = row_error
-        job.final_col_tolerance = col_error
+        job.final_row_tolerance = float(row_error)
+        job.final_col_tolerance = float(col_error)
         job.final_iteration = iteration
+        if self.keep_trace:
+            job.ras_scheme = scheme
         self.db_session.commit()
-        return final_out
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    File-backed RAS, for running jobs without access to the database.
+
+    A job is a directory holding its inputs in one of two layouts:
+
+    numpy (.npy) files:
+        extant_matrix.npy               the (row x col) matrix of amt_original values
+        amt_to_freeze_adhoc.npy         optional, the ad-hoc freeze values (nan for cells that aren't frozen)
+        bordertotals_rows.npy           the row border totals
+        bordertotals_columns.npy        the column border totals
+    The row and column ids are the positions in the arrays, starting at 1.
+
+    Parquet files (requires pyarrow), with the columns of the database tables:
+        fact_extant_matrix.parquet                  row_id, col_id, amt_original, amt_to_freeze_adhoc
+        fact_extant_bordertotals_rows.parquet       row_id, amt_original
+        fact_extant_bordertotals_columns.parquet    col_id, amt_original
+
+    Large .npy inputs are memory mapped. The results are written to the output directory
+    in the same layout as the inputs: the numpy layout gets amt_after_ras.npy, amt_frozen.npy,
+    bordertotals_rows_after_ras.npy, bordertotals_columns_after_ras.npy, row_multipliers.npy,
+    col_multipliers.npy and residual_trace.npy; the parquet layout gets the three input tables
+    with their amt_after_ras (and amt_frozen) columns filled in, fact_ras_multipliers.parquet and
+    fact_ras_residuals.parquet, ready to be loaded into the database in bulk. Both write job.json
+    with the job status, final tolerances, iteration and scheme.
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from ras_calculator import RASProcessor, apply_adhoc_freeze
+
+
+class FileRASProcessor(RASProcessor):
+    """RASProcessor that reads a job from files and writes its results to files"""
+
+    # warm_start_dir optionally names the output directory of an earlier job to warm start from
+    def __init__(self, input_dir, output_dir, warm_start_dir=None, job_id=None):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.warm_start_dir = warm_start_dir
+        self.job_id = job_id
+        # the multipliers and residual trace are always written with the results
+        self.warm_start = True
+        self.keep_trace = True
+        self.parquet = os.path.exists(self._input_path('fact_extant_matrix.parquet'))
+        self.job = {'job_id': job_id}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _input_path(self, name):
+        return os.path.join(self.input_dir, name)
+
+    def _output_path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def _read_parquet(self, path):
+        try:
+            return pd.read_parquet(path)
+        except ImportError:
+            raise ImportError('parquet job files require pyarrow (pip install pyarrow)')
+
+    def _write_parquet(self, df, name):
+        try:
+            df.to_parquet(self._output_path(name), index=False)
+        except ImportError:
+            raise ImportError('parquet job files require pyarrow (pip install pyarrow)')
+
+    def _write_job(self, **values):
+        self.job.update(values)
+        path = self._output_path('job.json')
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.job, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def get_job_properties(self, job_id):
+        return (None,)
+
+    def get_extant_matrix(self, job_id):
+        if self.parquet:
+            self.cells = self._read_parquet(self._input_path('fact_extant_matrix.parquet'))
+            if 'amt_to_freeze_adhoc' not in self.cells:
+                self.cells['amt_to_freeze_adhoc'] = np.nan
+            return self.build_extant_matrix(self.cells['row_id'].to_numpy(), self.cells['col_id'].to_numpy(),
+                                            self.cells['amt_original'].to_numpy(dtype=float, na_value=np.nan),
+                                            self.cells['amt_to_freeze_adhoc'].to_numpy(dtype=float, na_value=np.nan))
+
+        # the dense layout can't have duplicate or missing cells, only empty (nan) ones
+        matrix = np.load(self._input_path('extant_matrix.npy'), mmap_mode='r')
+        self.row_ids = np.arange(1, matrix.shape[0] + 1)
+        self.col_ids = np.arange(1, matrix.shape[1] + 1)
+        if os.path.exists(self._input_path('amt_to_freeze_adhoc.npy')):
+            self.adhoc_values = np.load(self._input_path('amt_to_freeze_adhoc.npy'), mmap_mode='r')
+        else:
+            self.adhoc_values = None
+        adhoc = np.zeros(matrix.shape, dtype=bool) if self.adhoc_values is None else ~np.isnan(self.adhoc_values)
+        values = np.where(adhoc, 0, matrix)
+        empty = np.isnan(values)
+        values[empty] = 0
+        self._qc_extant = {'success': 'extant matrix has exactly one value for every cell'}
+        if np.any(empty):
+            rows, cols = np.nonzero(empty)
+            self._qc_extant = {'error': 'extant matrix has {0} empty (nan) cells, first at row_id {1}, col_id {2}'.format(len(rows), self.row_ids[rows[0]], self.col_ids[cols[0]])}
+
+        self.use_sparse = self.prefers_sparse(values.shape, np.count_nonzero(values))
+        if self.use_sparse:
+            self.adhoc_mask = sparse.csr_matrix(adhoc)
+            return sparse.csr_matrix(values)
+        self.adhoc_mask = adhoc
+        return values
+
+    # multipliers saved by an earlier file job (see save_multipliers)
+    def get_warm_start_multipliers(self, job_id):
+        if self.warm_start_dir is None:
+            return None, None
+        multipliers = {'row': {}, 'col': {}}
+        table_path = os.path.join(self.warm_start_dir, 'fact_ras_multipliers.parquet')
+        if os.path.exists(table_path):
+            table = self._read_parquet(table_path)
+            for axis in multipliers:
+                rows = table[table['axis'] == axis]
+                multipliers[axis] = dict(zip(rows['position_id'].tolist(), rows['multiplier'].tolist()))
+        else:
+            for axis in multipliers:
+                values = np.load(os.path.join(self.warm_start_dir, '{0}_multipliers.npy'.format(axis)))
+                multipliers[axis] = dict(zip(range(1, len(values) + 1), values.tolist()))
+        return self.align_multipliers(multipliers)
+
+    def get_bt_rows(self, job_id):
+        if self.parquet:
+            self.bt_rows_table = self._read_parquet(self._input_path('fact_extant_bordertotals_rows.parquet')).sort_values('row_id', kind='stable')
+            return self.bt_rows_table['amt_original'].to_numpy(dtype=float)
+        return np.array(np.load(self._input_path('bordertotals_rows.npy'), mmap_mode='r'), dtype=float)
+
+    def get_bt_cols(self, job_id):
+        if self.parquet:
+            self.bt_cols_table = self._read_parquet(self._input_path('fact_extant_bordertotals_columns.parquet')).sort_values('col_id', kind='stable')
+            return self.bt_cols_table['amt_original'].to_numpy(dtype=float)
+        return np.array(np.load(self._input_path('bordertotals_columns.npy'), mmap_mode='r'), dtype=float)
+
+    def start_job(self):
+        self._write_job(status='running')
+
+    def finish_job_error(self):
+        self._write_job(status='error')
+
+    def save_multipliers(self, row_multipliers, col_multipliers):
+        if self.parquet:
+            self._write_parquet(pd.DataFrame({
+                'axis': ['row'] * len(row_multipliers) + ['col'] * len(col_multipliers),
+                'position_id': np.concatenate([self.row_ids, self.col_ids]),
+                'multiplier': np.concatenate([row_multipliers, col_multipliers]),
+            }), 'fact_ras_multipliers.parquet')
+        else:
+            np.save(self._output_path('row_multipliers.npy'), row_multipliers)
+            np.save(self._output_path('col_multipliers.npy'), col_multipliers)
+
+    def save_residual_trace(self, residual_trace):
+        residual_trace = np.asarray(residual_trace, dtype=float).reshape(-1, 2)
+        if self.parquet:
+            self._write_parquet(pd.DataFrame({
+                'iteration': np.arange(len(residual_trace)),
+                'row_error': residual_trace[:, 0],
+                'col_error': residual_trace[:, 1],
+            }), 'fact_ras_residuals.parquet')
+        else:
+            np.save(self._output_path('residual_trace.npy'), residual_trace)
+
+    def save_results(self, final_out, frozen_mat, bt_row_final, bt_col_final, row_error, col_error, iteration, scheme='simultaneous'):
+        if self.parquet:
+            # the matrix rows and columns are the sorted row and column ids (see build_extant_matrix)
+            row_pos = np.searchsorted(self.row_ids, self.cells['row_id'].to_numpy())
+            col_pos = np.searchsorted(self.col_ids, self.cells['col_id'].to_numpy())
+            new_values = np.asarray(final_out[row_pos, col_pos], dtype=float).ravel()
+            frozen_values = np.asarray(frozen_mat[row_pos, col_pos], dtype=float).ravel()
+            cells = self.cells.copy()
+            cells['amt_after_ras'], cells['amt_frozen'] = apply_adhoc_freeze(new_values, frozen_values, cells['amt_to_freeze_adhoc'].to_numpy(dtype=float, na_value=np.nan))
+            self._write_parquet(cells, 'fact_extant_matrix.parquet')
+            # border totals are matched to the results by their order
+            self._write_parquet(self.bt_rows_table.assign(amt_after_ras=np.asarray(bt_row_final, dtype=float)), 'fact_extant_bordertotals_rows.parquet')
+            self._write_parquet(self.bt_cols_table.assign(amt_after_ras=np.asarray(bt_col_final, dtype=float)), 'fact_extant_bordertotals_columns.parquet')
+        else:
+            new_values = final_out.toarray() if sparse.issparse(final_out) else np.asarray(final_out)
+            frozen_values = frozen_mat.toarray() if sparse.issparse(frozen_mat) else np.asarray(frozen_mat)
+            adhoc = np.full(new_values.shape, np.nan) if self.adhoc_values is None else self.adhoc_values
+            amt_after_ras, amt_frozen = apply_adhoc_freeze(new_values, frozen_values, adhoc)
+            np.save(self._output_path('amt_after_ras.npy'), amt_after_ras)
+            np.save(self._output_path('amt_frozen.npy'), amt_frozen)
+            np.save(self._output_path('bordertotals_rows_after_ras.npy'), np.asarray(bt_row_final, dtype=float))
+            np.save(self._output_path('bordertotals_columns_after_ras.npy'), np.asarray(bt_col_final, dtype=float))
+        self._write_job(status='completed', final_row_tolerance=float(row_error), final_col_tolerance=float(col_error),
+                        final_iteration=int(iteration), ras_scheme=scheme)
@@ -3,7 +3,7 @@
     ORM for the PostgreSQL database tables that will be used by the program
 """
 
-from sqlalchemy.orm import sessionmaker, relationship, backref, selectinload
+from sqlalchemy.orm import sessionmaker, relationship, backref, selectinload, deferred
 from sqlalchemy import Table, Column, Integer, String, DateTime, Text, Float, ForeignKey, create_engine, Enum
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -51,4 +51,30 @@ class JobProperties(Base):
     final_row_tolerance = Column(Float)
     final_col_tolerance = Column(Float)
     final_iteration = Column(Integer)
+    # added by sql/worker.sql; deferred so that jobs can run on databases without it
+    heartbeat_at = deferred(Column(DateTime))
+    # added by sql/warm_start.sql; deferred so that jobs can run on databases without it
+    warm_start_job_id = deferred(Column(Integer))
+    # added by sql/residual_trace.sql; deferred so that jobs can run on databases without it
+    ras_scheme = deferred(Column(String))
+    __table_args__ = {'schema': 'ras'}
+
+# created by sql/warm_start.sql
+class RASMultipliers(Base):
+    __tablename__ = 'fact_ras_multipliers'
+    id = Column(Integer, primary_key = True)
+    ras_id = Column(Integer)
+    axis = Column(Enum('row', 'col'))
+    position_id = Column(Integer)
+    multiplier = Column(Float)
+    __table_args__ = {'schema': 'ras'}
+
+# created by sql/residual_trace.sql
+class RASResiduals(Base):
+    __tablename__ = 'fact_ras_residuals'
+    id = Column(Integer, primary_key = True)
+    ras_id = Column(Integer)
+    iteration = Column(Integer)
+    row_error = Column(Float)
+    col_error = Column(Float)
     __table_args__ = {'schema': 'ras'}
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    Worker that drains pending jobs from the job table.
+
+    The worker process claims pending jobs (status 'pending' -> 'running') with
+    SELECT ... FOR UPDATE SKIP LOCKED, so several workers can share one job table
+    without running a job twice, and hands them to a pool of processes. Every pool
+    process keeps one engine for its whole life, so jobs reuse its connections
+    instead of connecting (and starting Python) per job. Jobs end as 'completed'
+    or 'error'.
+
+    The worker only claims as many jobs as it has free processes, and refreshes
+    JobProperties.heartbeat_at of its running jobs every poll. Running jobs whose
+    heartbeat is older than stale_after seconds belonged to a worker that died, and
+    are put back to 'pending' so another worker can run them. Jobs started outside
+    a worker have no heartbeat and are never reclaimed. The heartbeat column is
+    added by sql/worker.sql.
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+import multiprocessing
+import os
+import time
+import traceback
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from ras_calculator import RASProcessor, create_ras_engine
+from ras_models import JobProperties
+
+# engine of a pool process, created by init_worker
+worker_state = {}
+
+# the current time in UTC, as stored in JobProperties.heartbeat_at
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# claim up to limit pending jobs, oldest first, and mark them as running
+# returns the claimed job ids
+def claim_pending_jobs(engine, limit):
+    if limit <= 0:
+        return []
+    with Session(engine) as session:
+        job_ids = session.scalars(
+            select(JobProperties.id)
+            .where(JobProperties.status == 'pending')
+            .order_by(JobProperties.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if job_ids:
+            session.execute(update(JobProperties).where(JobProperties.id.in_(job_ids)).values(status='running', heartbeat_at=utc_now()))
+        session.commit()
+    return list(job_ids)
+
+# record that the worker is still running these jobs
+def heartbeat_jobs(engine, job_ids):
+    with Session(engine) as session:
+        session.execute(update(JobProperties).where(JobProperties.id.in_(job_ids)).where(JobProperties.status == 'running').values(heartbeat_at=utc_now()))
+        session.commit()
+
+# put running jobs without a heartbeat for stale_after seconds back to pending
+# returns the number of jobs that were put back
+def reclaim_stale_jobs(engine, stale_after):
+    with Session(engine) as session:
+        result = session.execute(
+            update(JobProperties)
+            .where(JobProperties.status == 'running')
+            .where(JobProperties.heartbeat_at < utc_now() - timedelta(seconds=stale_after))
+            .values(status='pending', heartbeat_at=None)
+        )
+        session.commit()
+    return result.rowcount
+
+# create the engine of a pool process
+def init_worker(database_uri):
+    worker_state['database_uri'] = database_uri
+    worker_state['engine'] = create_ras_engine(database_uri, pool_size=1, pool_pre_ping=True)
+
+# run one claimed job in a pool process
+# returns the job id and the error message, or None when the job completed
+def run_claimed_job(job_id, iterations=None, epsilon=None, scheme='simultaneous', warm_start=False, keep_trace=False):
+    # imported here because run_ras imports this module
+    from run_ras import run_job
+    ras_processor = RASProcessor(worker_state['database_uri'], job_id, engine=worker_state['engine'], warm_start=warm_start, keep_trace=keep_trace)
+    try:
+        run_job(ras_processor, job_id, iterations, epsilon, scheme)
+        return job_id, None
+    except Exception as e:
+        traceback.print_exc()
+        ras_processor.db_session.rollback()
+        ras_processor.finish_job_error()
+        return job_id, str(e)
+    finally:
+        ras_processor.db_session.remove()
+
+# claim and run pending jobs on a pool of processes
+# the worker runs until it is stopped, or when exit_when_idle is True, until no jobs are pending and the jobs it claimed have finished
+def run_worker(database_uri, processes=None, poll_interval=5, iterations=None, epsilon=None, exit_when_idle=False, scheme='simultaneous', stale_after=300, warm_start=False, keep_trace=False):
+    processes = processes or os.cpu_count()
+    engine = create_ras_engine(database_uri, pool_size=1)
+    # spawn, so the pool processes don't inherit the connections of this process
+    context = multiprocessing.get_context('spawn')
+    # running job id of every future
+    running = {}
+    last_heartbeat = None
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker, initargs=(database_uri,)) as pool:
+        while True:
+            for future in [f for f in running if f.done()]:
+                del running[future]
+                job_id, error = future.result()
+                print('Job {0}: {1}'.format(job_id, 'ERROR: ' + error if error else 'completed'))
+            if last_heartbeat is None or time.monotonic() - last_heartbeat >= poll_interval:
+                if running:
+                    heartbeat_jobs(engine, list(running.values()))
+                reclaimed = reclaim_stale_jobs(engine, stale_after)
+                if reclaimed:
+                    print('{0} stale running jobs put back to pending'.format(reclaimed))
+                last_heartbeat = time.monotonic()
+            # only claim jobs that can start right away, so no claimed job waits in the pool
+            job_ids = claim_pending_jobs(engine, processes - len(running))
+            for job_id in job_ids:
+                running[pool.submit(run_claimed_job, job_id, iterations, epsilon, scheme, warm_start, keep_trace)] = job_id
+            if job_ids:
+                continue
+            if not running:
+                if exit_when_idle:
+                    break
+                time.sleep(poll_interval)
+            else:
+                wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+    engine.dispose()
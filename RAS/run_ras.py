@@ -3,23 +3,117 @@
     Describe input arguments and run the RAS algorithm
 """
 # this is our RAS module
-from ras_calculator import RASProcessor
+from ras_calculator import RASProcessor, RAS_SCHEMES, batch_ras, create_ras_engine
+from ras_worker import run_worker
+from ras_files import FileRASProcessor
 from decouple import Config, RepositoryEnv
 import argparse
+import os
+import traceback
 import numpy as np
+from scipy import sparse
 
-def main(job_id, iterations=None, epsilon=None):
+def get_database_uri():
     # get the db URl (formatted consistent with: https://docs.sqlalchemy.org/en/20/core/engines.html#database-urls)
     # this accesses a .env file with our database secrets
     DOTENV_FILE = ''
     env_config = Config(RepositoryEnv(DOTENV_FILE))
-    db_info = env_config.get('DATABASE_URI2')
+    return env_config.get('DATABASE_URI2')
 
+def main(job_id, iterations=None, epsilon=None, scheme='simultaneous', warm_start=False, keep_trace=False):
+    db_info = get_database_uri()
     # initialize the RASProcessor with the job_id and db connection info
-    ras_processor = RASProcessor(db_info, job_id)
+    ras_processor = RASProcessor(db_info, job_id, warm_start=warm_start, keep_trace=keep_trace)
+    ras_processor.start_job()
+    run_job(ras_processor, job_id, iterations, epsilon, scheme)
+
+# run a job stored in files (see ras_files.py) instead of the database
+def run_files(input_dir, output_dir, warm_start_dir=None, iterations=None, epsilon=None, scheme='simultaneous'):
+    ras_processor = FileRASProcessor(input_dir, output_dir, warm_start_dir)
+    ras_processor.start_job()
+    return run_job(ras_processor, None, iterations, epsilon, scheme)
+
+# the max iterations and error threshold used when they aren't given
+def ras_settings(iterations=None, epsilon=None):
+    if not iterations:
+        iterations = 10000 if epsilon else 1000
+    return iterations, epsilon or 0.00001
+
+# load, check and balance one job with an initialized RASProcessor
+def run_job(ras_processor, job_id, iterations=None, epsilon=None, scheme='simultaneous'):
+    extant_matrix, ras_bt_rows, ras_bt_cols, ras_mat, frozen_bt_rows, frozen_bt_cols, frozen_mat, row_multipliers, col_multipliers = prepare_job(ras_processor, job_id)
+    # after running the checks, perform the ras
+    iterations, epsilon = ras_settings(iterations, epsilon)
+    result = ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols, iterations, epsilon, row_multipliers=row_multipliers, col_multipliers=col_multipliers, scheme=scheme)
+    return result
+
+# mark a job as an error after it failed outside the checks in prepare_job
+def fail_job(ras_processor, job_id, error):
+    print('Job {0}: ERROR: {1}'.format(job_id, error))
+    try:
+        ras_processor.db_session.rollback()
+        ras_processor.finish_job_error()
+    except Exception:
+        traceback.print_exc()
+
+# load several jobs and balance the jobs that have the same shape together with batch_ras
+# jobs that fail their checks, or fail while loading, balancing or saving, are marked as errors and skipped
+def run_batch(job_ids, iterations=None, epsilon=None, scheme='simultaneous', warm_start=False, keep_trace=False):
+    db_info = get_database_uri()
+    engine = create_ras_engine(db_info)
+    groups = {}
+    for job_id in job_ids:
+        ras_processor = RASProcessor(db_info, job_id, engine=engine, warm_start=warm_start, keep_trace=keep_trace)
+        try:
+            ras_processor.start_job()
+            inputs = prepare_job(ras_processor, job_id)
+        except ValueError as e:
+            # failed checks are already marked as errors by prepare_job
+            fail_job(ras_processor, job_id, e)
+            continue
+        except Exception as e:
+            traceback.print_exc()
+            fail_job(ras_processor, job_id, e)
+            continue
+        groups.setdefault(inputs[3].shape, []).append((job_id, ras_processor, inputs))
+
+    iterations, epsilon = ras_settings(iterations, epsilon)
+    for (row_n, col_n), jobs in groups.items():
+        try:
+            ras_mats = np.stack([inputs[3].toarray() if sparse.issparse(inputs[3]) else inputs[3] for _, _, inputs in jobs])
+            bt_rows = np.stack([inputs[1] for _, _, inputs in jobs])
+            bt_cols = np.stack([inputs[2] for _, _, inputs in jobs])
+            # members that aren't warm started start from 1
+            row_multipliers = np.stack([np.ones(row_n) if inputs[7] is None else inputs[7] for _, _, inputs in jobs])
+            col_multipliers = np.stack([np.ones(col_n) if inputs[8] is None else inputs[8] for _, _, inputs in jobs])
+            result, row_mult, col_mult, row_error, col_error, final_iteration, traces = batch_ras(ras_mats, bt_rows, bt_cols, iterations, epsilon, row_multipliers, col_multipliers, scheme)
+        except Exception as e:
+            traceback.print_exc()
+            for job_id, ras_processor, _ in jobs:
+                fail_job(ras_processor, job_id, e)
+            continue
+        for k, (job_id, ras_processor, inputs) in enumerate(jobs):
+            try:
+                frozen_mat = inputs[6].toarray() if sparse.issparse(inputs[6]) else inputs[6]
+                ras_processor.save_balanced(result[k], frozen_mat, inputs[4], inputs[5], row_mult[k], col_mult[k], row_error[k], col_error[k], int(final_iteration[k]), traces[k], scheme)
+            except Exception as e:
+                traceback.print_exc()
+                fail_job(ras_processor, job_id, e)
+                continue
+            print('Job {0}: completed at iteration {1} (row error {2}, col error {3})'.format(job_id, final_iteration[k], row_error[k], col_error[k]))
+
+# load a job and run the checks on it with an initialized RASProcessor
+# returns the extant matrix, the RAS inputs, the frozen values and the warm start multipliers;
+# a job that fails a check is marked as an error and a ValueError is raised
+def prepare_job(ras_processor, job_id):
     # this is using the ORM defined in ras_models.py
     job_props = ras_processor.get_job_properties(job_id)
     extant_matrix = ras_processor.get_extant_matrix(job_id)
+    if ras_processor._qc_extant.get('error'):
+        ras_processor.finish_job_error()
+        raise ValueError(ras_processor._qc_extant.get('error'))
+    # multipliers of an earlier job to start from, if the job names one
+    row_multipliers, col_multipliers = ras_processor.get_warm_start_multipliers(job_id)
     bt_rows = np.array(ras_processor.get_bt_rows(job_id), dtype='f')
     bt_cols = np.array(ras_processor.get_bt_cols(job_id), dtype='f')
 
@@ -53,31 +147,43 @@ def main(job_id, iterations=None, epsilon=None):
         raise ValueError(ras_processor._qc_check4.get('error'))
         exit(ras_processor._qc_check4.get('error'))
 
-    # after running the checks, perform the ras
-    if iterations and epsilon:
-        result = ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols, iterations, epsilon)
-    elif iterations:
-        result = ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols, iterations, 0.00001)
-    elif epsilon:
-        result = ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols, 10000, epsilon)
-    else:
-        result = ras_processor.perform_ras(ras_bt_rows, ras_bt_cols, ras_mat, frozen_mat, extant_matrix, frozen_bt_rows, frozen_bt_cols)
+    return extant_matrix, ras_bt_rows, ras_bt_cols, ras_mat, frozen_bt_rows, frozen_bt_cols, frozen_mat, row_multipliers, col_multipliers
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This script runs RAS given data that is stored in the PostgreSQL database.')
     # for testing, we have id 519 in the db
-    parser.add_argument('--job_id', '-j', type=int, help='Specify the job ID (must exist in the database).', required=True)
+    parser.add_argument('--job_id', '-j', type=int, help='Specify the job ID (must exist in the database). Required unless --job_ids, --worker or --input_dir is used.')
     parser.add_argument('--iterations', '-i', type=int, help='Specify the max iterations for RAS. The default value is 10000.')
     parser.add_argument('--epsilon', '-e', type=float, help='Error threshold for the RAS algorithm.')
+    parser.add_argument('--scheme', '-s', choices=RAS_SCHEMES, default='simultaneous', help='The RAS update scheme: simultaneous (row and column multipliers applied together), alternating (classic RAS, rows then columns) or accelerated (alternating with extrapolated multipliers). The default is simultaneous.')
+    parser.add_argument('--warm_start', action='store_true', help='Warm start jobs that name an earlier job (warm_start_job_id) from its multipliers, and save the final multipliers of every job. Requires the tables and columns in sql/warm_start.sql.')
+    parser.add_argument('--keep_trace', action='store_true', help='Save the RAS scheme and the row and column error after every iteration of every job. Requires the table and column in sql/residual_trace.sql.')
+    parser.add_argument('--job_ids', type=int, nargs='+', help='Run several jobs at once. Jobs with the same matrix shape are balanced together in one batch.')
+    parser.add_argument('--input_dir', help='Run the job stored in this directory instead of the database (see ras_files.py for the file layout).')
+    parser.add_argument('--output_dir', help='Directory the results of an --input_dir job are written to. The default is a results folder in the input directory.')
+    parser.add_argument('--warm_start_dir', help='Output directory of an earlier --input_dir job to warm start from.')
+    parser.add_argument('--worker', '-w', action='store_true', help='Run as a worker that claims and runs pending jobs from the job table until it is stopped. Requires the heartbeat column in sql/worker.sql.')
+    parser.add_argument('--processes', '-p', type=int, help='Number of jobs the worker runs at the same time. The default is the number of CPU cores.')
+    parser.add_argument('--poll_interval', type=float, default=5, help='Seconds the worker waits before checking for new jobs when there are none. The default value is 5.')
+    parser.add_argument('--exit_when_idle', action='store_true', help='Stop the worker once no jobs are pending and the jobs it claimed have finished.')
+    parser.add_argument('--stale_after', type=float, default=300, help='Seconds without a heartbeat after which the worker puts a running job back to pending, because the worker running it has died. The default value is 300.')
     args = parser.parse_args()
     job_id = args.job_id
     it_number = args.iterations
     eps = args.epsilon
-    if it_number and eps:
-        main(job_id, it_number, eps)
+    if args.input_dir:
+        run_files(args.input_dir, args.output_dir or os.path.join(args.input_dir, 'results'), args.warm_start_dir, it_number, eps, args.scheme)
+    elif args.job_ids:
+        run_batch(args.job_ids, it_number, eps, args.scheme, args.warm_start, args.keep_trace)
+    elif args.worker:
+        run_worker(get_database_uri(), args.processes, args.poll_interval, it_number, eps, args.exit_when_idle, args.scheme, args.stale_after, args.warm_start, args.keep_trace)
+    elif job_id is None:
+        parser.error('--job_id is required unless --job_ids, --worker or --input_dir is used')
+    elif it_number and eps:
+        main(job_id, it_number, eps, args.scheme, args.warm_start, args.keep_trace)
     elif it_number:
-        main(job_id, it_number, None)
+        main(job_id, it_number, None, args.scheme, args.warm_start, args.keep_trace)
     elif eps:
-        main(job_id, None, eps)
+        main(job_id, None, eps, args.scheme, args.warm_start, args.keep_trace)
     else:
-        main(job_id)
+        main(job_id, scheme=args.scheme, warm_start=args.warm_start, keep_trace=args.keep_trace)
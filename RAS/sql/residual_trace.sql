@@ -0,0 +1,13 @@
+-- residual traces of RAS jobs (run_ras.py --keep_trace)
+-- the RAS scheme of every job is saved in ras_scheme, and the row and column error after
+-- every iteration in fact_ras_residuals
+ALTER TABLE ras.properties_ras_jobs ADD COLUMN IF NOT EXISTS ras_scheme varchar;
+
+CREATE TABLE IF NOT EXISTS ras.fact_ras_residuals (
+    id serial PRIMARY KEY,
+    ras_id integer,
+    iteration integer,
+    row_error double precision,
+    col_error double precision
+);
+CREATE INDEX IF NOT EXISTS fact_ras_residuals_ras_id_idx ON ras.fact_ras_residuals (ras_id);
@@ -0,0 +1,13 @@
+-- warm started RAS jobs (run_ras.py --warm_start)
+-- a job is warm started from the final multipliers of the job named in warm_start_job_id,
+-- and the final multipliers of every job are saved in fact_ras_multipliers
+ALTER TABLE ras.properties_ras_jobs ADD COLUMN IF NOT EXISTS warm_start_job_id integer;
+
+CREATE TABLE IF NOT EXISTS ras.fact_ras_multipliers (
+    id serial PRIMARY KEY,
+    ras_id integer,
+    axis varchar(3) CHECK (axis IN ('row', 'col')),
+    position_id integer,
+    multiplier double precision
+);
+CREATE INDEX IF NOT EXISTS fact_ras_multipliers_ras_id_idx ON ras.fact_ras_multipliers (ras_id);
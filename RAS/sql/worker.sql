@@ -0,0 +1,4 @@
+-- heartbeat of the jobs run by ras_worker.py (run_ras.py --worker)
+-- a worker refreshes heartbeat_at of its running jobs every poll, and puts running jobs whose
+-- heartbeat is older than --stale_after seconds back to pending
+ALTER TABLE ras.properties_ras_jobs ADD COLUMN IF NOT EXISTS heartbeat_at timestamp;
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+This code calibrates the beta and gamma parameters of the gravity model cost
+function for a single trade commodity. The impedence matrix and supply/demand
+data are loaded once, and every candidate is scored against either a reference
+shipment matrix or a target mean trip length.
+
+"""
+
+import argparse
+import time
+import numpy as np
+from gravity_trade import GravityModel
+from shipment_io import read_shipment_matrix
+from run_model import get_impedence_matrix, get_all_supply_demand, supply_demand_frame
+
+# define command line arguments
+parser = argparse.ArgumentParser(description='This program calibrates the beta and gamma parameters of the gravity model for a single trade commodity. The output is a csv file with the score of every candidate.')
+parser.add_argument('-impedence', help="The name of the impedence to calibrate against. Options include: hwyimpedence, rrimpedence, waterimpedence, and comboimpedence.", required=True)
+parser.add_argument('-trade_commodity_id', type=int, help="The trade commodity index to calibrate.", required=True)
+parser.add_argument('-betas', help="The beta values to try, given as start:stop:step (e.g. -betas=-2.0:-0.5:0.1) or as a comma separated list. If not specified, beta is found with an optimizer.", required=False)
+parser.add_argument('-gammas', default='0', help="The gamma values to try, given as start:stop:step or as a comma separated list. The default is 0.", required=False)
+parser.add_argument('-fit_gamma', action='store_true', help="When beta is found with the optimizer, fit gamma as well (starting from the first -gammas value).", required=False)
+parser.add_argument('-reference', help="Path to a reference shipment matrix (csv or npz) to score the candidates against.", required=False)
+parser.add_argument('-target_mean_trip_length', type=float, help="Score the candidates by how close their mean trip length is to this value.", required=False)
+parser.add_argument('-workers', type=int, help="The number of candidates scored at the same time. The default is the number of CPU cores.", required=False)
+
+# parse a start:stop:step range or a comma separated list of values
+def parse_values(values):
+    if ':' in values:
+        start, stop, step = (float(x) for x in values.split(':'))
+        return np.arange(start, stop + step / 2, step).round(10).tolist()
+    return [float(x) for x in values.split(',')]
+
+def main():
+    args = parser.parse_args()
+    if args.reference is None and args.target_mean_trip_length is None:
+        print('ERROR: A REFERENCE MATRIX OR A TARGET MEAN TRIP LENGTH IS REQUIRED')
+        exit()
+    start_time = time.time()
+    imp_matrix, place_ids = get_impedence_matrix(args.impedence)
+    commodities, supply, demand, complete = get_all_supply_demand(place_ids, [args.trade_commodity_id])
+    if len(commodities) != 1 or not complete[0]:
+        print('ERROR: INVALID TRADE COMMODITY ID')
+        exit()
+    supp_demand_df = supply_demand_frame(place_ids, supply[0], demand[0])
+    reference = read_shipment_matrix(args.reference, dense=True) if args.reference else None
+
+    gravity_model = GravityModel(np.asarray(imp_matrix), supp_demand_df)
+    gravity_model.format_data()
+    gammas = parse_values(args.gammas)
+    if args.betas:
+        results = gravity_model.calibrate(parse_values(args.betas), gammas, reference, args.target_mean_trip_length, args.workers)
+    else:
+        results = gravity_model.optimize_parameters(gamma=gammas[0], reference=reference, target_mean_trip_length=args.target_mean_trip_length, fit_gamma=args.fit_gamma)
+    # output is saved to the output folder (not tracked by git)
+    results.to_csv('./output/calibration_{0}_tci_{1}.csv'.format(args.impedence, args.trade_commodity_id), index=False)
+    print('Best beta: {0}, best gamma: {1}'.format(gravity_model.best_beta, gravity_model.best_gamma))
+    print('Runtime: ', time.time() - start_time, ' seconds')
+
+# only run the program if this file is called directly
+if __name__ == '__main__':
+    main()
@@ -14,16 +14,196 @@ Gravity model Based on Wilson, A.G. (1967), A Statistical Theory of
 Spatial Distribution Models. Transportation Research 1 (3), pp. 252-270
 """
  
+import contextlib
+import os
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy import integrate
+from scipy import optimize
+from scipy import sparse
+
+
+def cost_matrix(dist, alpha=1, beta=-1.1, gamma=0):
+    """
+    Calculates the cost (deterrence) matrix from an impedence matrix.
+
+    For a sparse impedence matrix only the stored pairs are transformed.
+    """
+    if sparse.issparse(dist):
+        cost_mat = dist.copy()
+        cost_mat.data = cost_matrix(cost_mat.data, alpha, beta, gamma)
+        return cost_mat
+    return alpha * np.power(dist, beta) * np.exp(gamma * dist)
+
+
+def _keep_top_k(rows, cols, vals, top_k):
+    """Keeps the top_k smallest values in each row of (rows, cols, vals) triplets."""
+    order = np.lexsort((vals, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < top_k
+    return rows[keep], cols[keep], vals[keep]
+
+
+def truncate_impedence(dist, max_impedence=None, top_k=None, chunk_size=1024):
+    """
+    Builds a sparse (CSR) impedence matrix that only keeps nearby pairs.
+
+    Pairs with an impedence above max_impedence are dropped, and top_k keeps
+    only the top_k closest destinations of each origin. Missing (NaN) pairs
+    are always dropped. A dense matrix is read in blocks of chunk_size rows
+    so the full set of pairs is never held at once.
+    """
+    if sparse.issparse(dist):
+        pairs = dist.tocoo()
+        blocks = [(pairs.row, pairs.col, pairs.data)]
+    else:
+        blocks = []
+        for start in range(0, dist.shape[0], chunk_size):
+            block = np.asarray(dist[start:start + chunk_size])
+            rows, cols = np.nonzero(~np.isnan(block))
+            blocks.append((rows + start, cols, block[rows, cols]))
+
+    kept = []
+    for rows, cols, vals in blocks:
+        keep = ~np.isnan(vals)
+        if max_impedence is not None:
+            keep &= vals <= max_impedence
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        if top_k is not None:
+            rows, cols, vals = _keep_top_k(rows, cols, vals, top_k)
+        kept.append((rows, cols, vals))
+
+    rows, cols, vals = (np.concatenate(part) for part in zip(*kept))
+    return sparse.csr_matrix((vals, (rows, cols)), shape=dist.shape)
+
+
+def scale_sparse(mat, row_factors=None, col_factors=None):
+    """Scales the rows and columns of a CSR matrix without building diagonal matrices."""
+    scaled = mat.copy()
+    if row_factors is not None:
+        scaled.data *= np.repeat(row_factors, np.diff(scaled.indptr))
+    if col_factors is not None:
+        scaled.data *= col_factors[scaled.indices]
+    return scaled
+
+
+def safe_reciprocal(x):
+    """Returns 1 / x, with zero wherever x is zero."""
+    return np.reciprocal(x, out=np.zeros_like(x), where=x != 0)
+
+
+def finish_shipments(S, tot_dem):
+    """
+    Post-processes a shipping matrix in place and returns it.
+
+    Flows below 1 are set to zero, and the remaining flows are rescaled so
+    that they add up to the total demand. Works on dense and sparse (CSR)
+    matrices; calibration applies it too, so candidates are scored on the
+    same matrix the model writes.
+    """
+    # Set any values less than this value to zero
+    if sparse.issparse(S):
+        S.data[S.data < 1] = 0
+        S.eliminate_zeros()
+        S.data *= tot_dem / S.sum()
+    else:
+        S[S < 1] = 0
+        S *= S.dtype.type(tot_dem / np.sum(S, dtype=np.float64))
+    return S
+
+
+class PeakMemory:
+    """
+    Context manager that records the peak memory allocated inside the block.
+
+    numpy reports its array allocations to tracemalloc, so the peak includes
+    every matrix built by the model. tracemalloc traces the whole process, so
+    allocations made by other threads inside the block are counted too. The
+    peak (in bytes) is kept in self.peak.
+    """
+    def __enter__(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc):
+        self.peak = tracemalloc.get_traced_memory()[1] - self.base
+        if self.started:
+            tracemalloc.stop()
+        return False
+
+
+def balance_factors(cost_mat, sup, dem, tol=1e-6, max_iterations=100, accelerator=None, omega=1.2, memory=5):
+    """
+    Solves the balancing factors A and B of the doubly constrained model.
+
+    A sweep sets A = 1 / (C (D * B)) and then B = 1 / (C' (O * A)), so the
+    column totals hold after every sweep. The loop stops once the largest
+    relative row total error is below tol, or after max_iterations sweeps.
+    Only vectors of length n are allocated inside the loop.
+
+    accelerator can be None, 'overrelax' or 'anderson'. Both work on log(A):
+    'overrelax' scales each update by omega, and 'anderson' extrapolates from
+    the last memory updates.
+
+    Returns A, B, the number of sweeps and the final residual.
+    """
+    if accelerator not in (None, 'overrelax', 'anderson'):
+        raise ValueError('unknown accelerator: {0}'.format(accelerator))
+
+    A = np.ones_like(sup)
+    B = safe_reciprocal(cost_mat.T @ (sup * A))
+    supplied = sup > 0
+    residual = np.inf
+    x_hist = []
+    g_hist = []
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        A_new = safe_reciprocal(cost_mat @ (dem * B))
+        # the row totals of the current flows are O * A / A_new
+        active = supplied & (A_new > 0)
+        residual = np.max(np.abs(A[active] / A_new[active] - 1), initial=0)
+        if residual < tol:
+            break
+
+        if accelerator is not None:
+            x = np.log(A[active])
+            g = np.log(A_new[active])
+            if accelerator == 'overrelax':
+                A_new[active] = np.exp(x + omega * (g - x))
+            elif len(x_hist) and len(x_hist[-1]) == len(x):
+                x_hist.append(x)
+                g_hist.append(g)
+                x_hist = x_hist[-(memory + 1):]
+                g_hist = g_hist[-(memory + 1):]
+                f = np.array(g_hist) - np.array(x_hist)
+                dF = np.diff(f, axis=0).T
+                dG = np.diff(np.array(g_hist), axis=0).T
+                weights = np.linalg.lstsq(dF, f[-1], rcond=None)[0]
+                A_new[active] = np.exp(g - dG @ weights)
+            else:
+                x_hist = [x]
+                g_hist = [g]
+
+        A = A_new
+        B = safe_reciprocal(cost_mat.T @ (sup * A))
+    return A, B, iteration, residual
 
 
 class GravityModel:
-    def __init__(self, dist, comm_sup_dem):
+    def __init__(self, dist, comm_sup_dem, cost_mat=None):
         self.dist = dist
         self.comm_sup_dem = comm_sup_dem
+        # a cost matrix that was already calculated (e.g. shared across commodities)
+        self.cost_mat = cost_mat
 
     def format_data(self):
         """Reads the input data from the specified files."""
@@ -33,13 +213,91 @@ class GravityModel:
         self.tot_sup = sum(self.sup)
         self.tot_dem = sum(self.dem)
 
-    def calculate_cost_matrix(self):
+    def calculate_cost_matrix(self, alpha=1, beta=-1.1, gamma=0):
         """Calculates the cost matrix."""
-        self.alpha = 1
-        self.beta = -1.1
-        self.gamma = 0
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+        if self.cost_mat is None:
+            self.cost_mat = cost_matrix(self.dist, self.alpha, self.beta, self.gamma)
+
+    def score_parameters(self, beta, gamma=0, reference=None, target_mean_trip_length=None, tol=1e-6, max_iterations=100):
+        """
+        Scores one (beta, gamma) candidate for calibration.
+
+        The flows are compared against a reference flow matrix (root mean
+        squared error) or a target mean trip length (absolute difference).
+        format_data must be called first. The log of the impedence matrix is
+        calculated once and reused by every candidate.
+        """
+        if getattr(self, 'log_dist', None) is None:
+            self.log_dist = np.log(self.dist)
+        # alpha cancels out in the balancing factors, so it isn't needed here
+        cost_mat = np.exp(beta * self.log_dist + gamma * self.dist)
+        sup = self.sup.to_numpy(dtype=float)
+        dem = self.dem.to_numpy(dtype=float)
+        A, B, iterations, residual = balance_factors(cost_mat, sup, dem, tol=tol, max_iterations=max_iterations)
+        # flows = (O * A) c (D * B), built in place in the cost matrix buffer and
+        # post-processed like the shipping matrix of calculate_shipping_matrix
+        flows = cost_mat
+        flows *= (sup * A)[:, np.newaxis]
+        flows *= dem * B
+        finish_shipments(flows, self.tot_dem)
+        if reference is not None:
+            reference = reference.toarray() if sparse.issparse(reference) else np.asarray(reference)
+            score = np.sqrt(np.mean(np.square(flows - reference)))
+        elif target_mean_trip_length is not None:
+            mean_trip_length = np.sum(flows * self.dist) / np.sum(flows)
+            score = abs(mean_trip_length - target_mean_trip_length)
+        else:
+            raise ValueError('a reference flow matrix or a target mean trip length is required')
+        return {'beta': beta, 'gamma': gamma, 'score': score, 'iterations': iterations, 'residual': residual}
+
+    def calibrate(self, betas, gammas=(0,), reference=None, target_mean_trip_length=None, workers=None, tol=1e-6, max_iterations=100):
+        """
+        Scores a grid of beta and gamma values and keeps the best pair.
 
-        self.cost_mat = self.alpha * np.power(self.dist, self.beta) * np.exp(self.gamma * self.dist)
+        Candidates are scored in parallel on a thread pool (numpy releases the
+        GIL for the heavy array work). Every worker holds about two n x n
+        arrays, so workers should be limited for large impedence matrices.
+        The scores are returned as a DataFrame (best first) and the best pair
+        is kept in self.best_beta and self.best_gamma.
+        """
+        candidates = list(product(betas, gammas))
+        if getattr(self, 'log_dist', None) is None:
+            self.log_dist = np.log(self.dist)
+
+        def score(candidate):
+            return self.score_parameters(candidate[0], candidate[1], reference, target_mean_trip_length, tol, max_iterations)
+
+        with ThreadPoolExecutor(max(1, min(workers or os.cpu_count(), len(candidates)))) as pool:
+            results = list(pool.map(score, candidates))
+        self.calibration = pd.DataFrame(results).sort_values('score').reset_index(drop=True)
+        self.best_beta = self.calibration.loc[0, 'beta']
+        self.best_gamma = self.calibration.loc[0, 'gamma']
+        return self.calibration
+
+    def optimize_parameters(self, beta=-1.1, gamma=0, reference=None, target_mean_trip_length=None, fit_gamma=True, tol=1e-6, max_iterations=100):
+        """
+        Searches for the best beta (and gamma) with a Nelder-Mead optimizer.
+
+        Starts from the given beta and gamma. Every evaluated candidate is kept
+        in self.calibration, and the best pair in self.best_beta and self.best_gamma.
+        """
+        results = []
+
+        def objective(x):
+            result = self.score_parameters(x[0], x[1] if fit_gamma else gamma, reference, target_mean_trip_length, tol, max_iterations)
+            results.append(result)
+            return result['score']
+
+        start = [beta, gamma] if fit_gamma else [beta]
+        optimize.minimize(objective, start, method='Nelder-Mead')
+        self.calibration = pd.DataFrame(results).sort_values('score').reset_index(drop=True)
+        self.best_beta = self.calibration.loc[0, 'beta']
+        self.best_gamma = self.calibration.loc[0, 'gamma']
+        return self.calibration
 
     def calculate_attraction_matrices(self):
         """Calculates the attraction matrices."""
@@ -49,35 +307,26 @@ class GravityModel:
         self.att_org = np.matmul(self.s_d, self.cost_mat)
         self.att_des = np.matmul(self.cost_mat, self.d_d)
 
-    def calculate_A_and_B(self):
-        """Calculates A and B."""
-        def calculate_MS_MD_A_B(MS, MD, A, B, iteration):
-            if iteration == 100:
-                return MS, MD, A, B,
-            else:
-                MS_new = self.att_org * A[:, np.newaxis]
-                MD_new = self.att_des * B
-                A_new = np.reciprocal(np.sum(MD, axis=1), where=np.sum(MD, axis=1) != 0)
-                B_new = np.reciprocal(np.sum(MS, axis=0), where=np.sum(MS, axis=0) != 0)
-                return calculate_MS_MD_A_B(MS_new, MD_new, A_new, B_new, iteration + 1)
-
-        self.initial_MS = self.att_org
-        self.initial_B = 1 / (np.sum(self.att_org, axis=0))
-        self.initial_MD = self.initial_B * self.att_des
-
-        self.initial_A = 1
-        self.initial_A = np.array([1.0])
-
-        self.final_MS, self.final_MD, self.final_A, self.final_B = calculate_MS_MD_A_B(
-            self.initial_MS,
-            self.initial_MS,
-            self.initial_A,
-            self.initial_B,
-            0,
-        )
+    def calculate_A_and_B(self, tol=1e-6, max_iterations=100, accelerator=None, omega=1.2, memory=5):
+        """
+        Calculates A and B.
 
-        self.A = self.final_A
-        self.B = self.final_B
+        A and B are updated in turn until the relative row total error falls
+        below tol or max_iterations sweeps have been made. The number of sweeps
+        and the final error are kept in self.iterations and self.residual.
+        """
+        self.A, self.B, self.iterations, self.residual = balance_factors(
+            self.cost_mat,
+            self.sup.to_numpy(dtype=float),
+            self.dem.to_numpy(dtype=float),
+            tol=tol,
+            max_iterations=max_iterations,
+            accelerator=accelerator,
+            omega=omega,
+            memory=memory,
+        )
+        self.final_A = self.A
+        self.final_B = self.B
 
     def calculate_prob_matrix(self):
         """Calculates the probability matrix."""
@@ -89,16 +338,7 @@ class GravityModel:
 
     def calculate_shipping_matrix(self):
         """Calculates the shipping matrix."""
-        S = np.matmul(self.s_d, self.prob)
-        # Set any values less than this value to zero
-        S[S < 1] = 0
-        row_totals = np.sum(S, axis=1)
-        col_totals = np.sum(S, axis=0)
-
-        row_factor = self.tot_sup / np.sum(row_totals)
-        col_factor = self.tot_dem / np.sum(col_totals)
-
-        S *= col_factor
+        S = finish_shipments(np.matmul(self.s_d, self.prob), self.tot_dem)
 
         S_rowsum = np.sum(S, axis=1)
         S_colsum = np.sum(S, axis=0)
@@ -106,3 +346,192 @@ class GravityModel:
         self.total_shipped_supply = sum(S_rowsum)
         self.total_shipped_demand = sum(S_colsum)
         self.S = S
+
+
+class SparseGravityModel(GravityModel):
+    """
+    Gravity model on a sparse (CSR) impedence matrix.
+
+    Only the origin-destination pairs stored in the impedence matrix (see
+    truncate_impedence) are modelled, so memory scales with the number of
+    kept pairs instead of n x n. The attraction, balancing and shipping steps
+    scale the stored values directly instead of multiplying diagonal matrices.
+    """
+    def calculate_attraction_matrices(self):
+        """Calculates the destination attraction matrix."""
+        self.att_des = scale_sparse(self.cost_mat, col_factors=self.dem.to_numpy(dtype=float))
+
+    def calculate_prob_matrix(self):
+        """Calculates the probability matrix."""
+        self.prob = scale_sparse(self.att_des, row_factors=self.A, col_factors=self.B)
+
+    def calculate_shipping_matrix(self):
+        """Calculates the shipping matrix."""
+        S = finish_shipments(scale_sparse(self.prob, row_factors=self.sup.to_numpy(dtype=float)), self.tot_dem)
+
+        self.total_shipped_supply = np.sum(S.sum(axis=1))
+        self.total_shipped_demand = np.sum(S.sum(axis=0))
+        self.S = S
+
+
+class LeanGravityModel(GravityModel):
+    """
+    Gravity model that keeps as few n x n arrays alive as possible.
+
+    Diagonal matrices are replaced by broadcasting, the attraction and
+    probability matrices are never built, and the shipping matrix is written
+    into the cost matrix buffer when the model owns it. dtype can be set to
+    np.float32 to halve the memory again. run(measure_memory=True) records
+    the peak memory of the whole model in self.peak_memory.
+    """
+    def __init__(self, dist, comm_sup_dem, cost_mat=None, dtype=np.float64):
+        super().__init__(dist, comm_sup_dem, cost_mat)
+        self.dtype = np.dtype(dtype)
+        self.owns_cost_mat = cost_mat is None
+
+    def calculate_cost_matrix(self, alpha=1, beta=-1.1, gamma=0, chunk_size=1024):
+        """Calculates the cost matrix in place, a block of rows at a time."""
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+        if self.cost_mat is not None:
+            return
+        self.cost_mat = np.empty(self.dist.shape, dtype=self.dtype)
+        for start in range(0, self.dist.shape[0], chunk_size):
+            block = self.cost_mat[start:start + chunk_size]
+            block[...] = self.dist[start:start + chunk_size]
+            decay = np.exp(gamma * block) if gamma != 0 else None
+            np.power(block, beta, out=block)
+            if decay is not None:
+                block *= decay
+            if alpha != 1:
+                block *= alpha
+
+    def calculate_attraction_matrices(self):
+        """The attraction matrices are applied by broadcasting, so nothing is built here."""
+        pass
+
+    def calculate_A_and_B(self, tol=1e-6, max_iterations=100, accelerator=None, omega=1.2, memory=5):
+        """Calculates A and B in the model's dtype."""
+        self.A, self.B, self.iterations, self.residual = balance_factors(
+            self.cost_mat,
+            self.sup.to_numpy(dtype=self.dtype),
+            self.dem.to_numpy(dtype=self.dtype),
+            tol=tol,
+            max_iterations=max_iterations,
+            accelerator=accelerator,
+            omega=omega,
+            memory=memory,
+        )
+        self.final_A = self.A
+        self.final_B = self.B
+
+    def calculate_prob_matrix(self):
+        """The probability matrix is folded into the shipping matrix, so nothing is built here."""
+        pass
+
+    def calculate_shipping_matrix(self):
+        """Calculates the shipping matrix, reusing the cost matrix buffer when possible."""
+        sup = self.sup.to_numpy(dtype=self.dtype)
+        dem = self.dem.to_numpy(dtype=self.dtype)
+        if self.owns_cost_mat:
+            S = self.cost_mat
+            self.cost_mat = None
+        else:
+            S = np.empty(self.cost_mat.shape, dtype=self.dtype)
+        np.multiply(self.cost_mat if self.cost_mat is not None else S, (sup * self.A)[:, np.newaxis], out=S)
+        S *= dem * self.B
+        finish_shipments(S, self.tot_dem)
+
+        self.total_shipped_supply = np.sum(np.sum(S, axis=1, dtype=np.float64))
+        self.total_shipped_demand = np.sum(np.sum(S, axis=0, dtype=np.float64))
+        self.S = S
+
+    def run(self, measure_memory=False, **solver_options):
+        """
+        Runs every step of the model.
+
+        With measure_memory, the peak memory is recorded in self.peak_memory
+        (otherwise it is None). Other threads should be idle while it is
+        measured, as their allocations are counted too (see PeakMemory).
+        """
+        with PeakMemory() if measure_memory else contextlib.nullcontext() as peak_memory:
+            self.format_data()
+            self.calculate_cost_matrix()
+            self.calculate_A_and_B(**solver_options)
+            self.calculate_shipping_matrix()
+        self.peak_memory = peak_memory.peak if measure_memory else None
+        return self.S
+
+
+class BatchGravityModel:
+    """
+    Runs the gravity model for a block of commodities at once.
+
+    The cost matrix only depends on the impedence matrix and the alpha, beta
+    and gamma parameters, so it is calculated once and shared by every
+    commodity. Supply and demand are (commodity x place) arrays, and the
+    balancing factors A and B are solved for the whole block with matrix
+    products against the cost matrix instead of per-commodity n x n matrices.
+    """
+    def __init__(self, dist, alpha=1, beta=-1.1, gamma=0, cost_mat=None):
+        self.dist = dist
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.cost_mat = cost_mat
+
+    def calculate_cost_matrix(self):
+        """Calculates the cost matrix (only if it was not passed in)."""
+        if self.cost_mat is None:
+            self.cost_mat = cost_matrix(self.dist, self.alpha, self.beta, self.gamma)
+
+    def format_data(self, supply, demand):
+        """Sets the (commodity x place) supply and demand arrays for the block."""
+        self.sup = np.atleast_2d(np.asarray(supply, dtype=float))
+        self.dem = np.atleast_2d(np.asarray(demand, dtype=float))
+
+        self.tot_sup = np.sum(self.sup, axis=1)
+        self.tot_dem = np.sum(self.dem, axis=1)
+
+    def calculate_A_and_B(self, tol=1e-6, max_iterations=100):
+        """
+        Calculates A and B for every commodity in the block.
+
+        Each sweep updates A from B and then B from A, as in balance_factors.
+        The block stops once every commodity's relative row total error is
+        below tol. The per-commodity errors are kept in self.residual.
+        """
+        A = np.ones_like(self.sup)
+        B = safe_reciprocal(np.matmul(self.sup * A, self.cost_mat))
+        supplied = self.sup > 0
+        iteration = 0
+        for iteration in range(1, max_iterations + 1):
+            A_new = safe_reciprocal(np.matmul(self.dem * B, self.cost_mat.T))
+            active = supplied & (A_new > 0)
+            row_error = np.abs(np.divide(A, A_new, out=np.ones_like(A), where=active) - 1)
+            self.residual = np.max(row_error, axis=1)
+            if np.all(self.residual < tol):
+                break
+            A = A_new
+            B = safe_reciprocal(np.matmul(self.sup * A, self.cost_mat))
+        self.A = A
+        self.B = B
+        self.iterations = iteration
+
+    def calculate_shipping_matrix(self, k):
+        """Calculates the shipping matrix for the k-th commodity in the block."""
+        S = finish_shipments((self.sup[k] * self.A[k])[:, np.newaxis] * self.cost_mat * (self.dem[k] * self.B[k]), self.tot_dem[k])
+
+        S_rowsum = np.sum(S, axis=1)
+        S_colsum = np.sum(S, axis=0)
+
+        self.total_shipped_supply = np.sum(S_rowsum)
+        self.total_shipped_demand = np.sum(S_colsum)
+        return S
+
+    def shipping_matrices(self):
+        """Yields (block position, shipping matrix) for every commodity in the block."""
+        for k in range(self.sup.shape[0]):
+            yield k, self.calculate_shipping_matrix(k)
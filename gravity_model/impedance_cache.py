@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+On-disk cache for the pivoted impedence matrix.
+
+Pulling the (from, to, impedence) rows from the database and pivoting them takes
+minutes, so the square matrix and the place id order of its rows/columns are saved
+as .npy files. The cache is keyed by the impedence column and a fingerprint of the
+source table, and later runs open the files as read-only memory maps.
+
+"""
+
+import glob
+import hashlib
+import os
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func, select
+
+
+# fingerprint of the impedence table, used to tell when the cache is out of date
+# (row count, id range and column sums are cheap to aggregate on the database side)
+def table_fingerprint(session, table, impedence):
+    query = select(
+        func.count(table.id),
+        func.min(table.id),
+        func.max(table.id),
+        func.sum(table.fromplaceid),
+        func.sum(table.toplaceid),
+        func.sum(impedence),
+    )
+    summary = session.execute(query).one()
+    return hashlib.sha1(repr(tuple(summary)).encode('utf-8')).hexdigest()[:16]
+
+def cache_paths(cache_dir, impedence_var, fingerprint):
+    base = os.path.join(cache_dir, '{0}_{1}'.format(impedence_var, fingerprint))
+    return base + '.npy', base + '_places.npy'
+
+# open a cached matrix as a memory map
+# returns (matrix, place_ids), or None if there is no cache for this fingerprint
+def load_cached_matrix(cache_dir, impedence_var, fingerprint):
+    matrix_path, places_path = cache_paths(cache_dir, impedence_var, fingerprint)
+    if not (os.path.exists(matrix_path) and os.path.exists(places_path)):
+        return None
+    matrix = np.load(matrix_path, mmap_mode='r')
+    place_ids = np.load(places_path)
+    return matrix, place_ids
+
+# save a matrix to the cache, removing older caches of the same impedence column
+def save_cached_matrix(cache_dir, impedence_var, fingerprint, matrix, place_ids):
+    os.makedirs(cache_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(cache_dir, '{0}_*.npy'.format(impedence_var))):
+        os.remove(path)
+    matrix_path, places_path = cache_paths(cache_dir, impedence_var, fingerprint)
+    # write to temporary files first so a crash never leaves a partial cache behind
+    for path, array in ((places_path, place_ids), (matrix_path, matrix)):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+# stream the (from, to, impedence) rows from the database into numpy arrays
+def fetch_impedence_rows(session, table, impedence, chunk_size=500000):
+    query = select(table.fromplaceid, table.toplaceid, impedence).execution_options(yield_per=chunk_size)
+    chunks = [np.array([tuple(row) for row in rows], dtype=float) for rows in session.execute(query).partitions()]
+    if not chunks:
+        return np.empty(0), np.empty(0), np.empty(0)
+    rows = np.concatenate(chunks)
+    return rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64), rows[:, 2]
+
+# scatter (from, to, impedence) rows directly into a square matrix
+# rows are ordered by from place id and columns by to place id, the same as the
+# pivot_table this replaces. Missing pairs are left as NaN
+def build_impedence_matrix(from_ids, to_ids, values):
+    from_places = np.unique(from_ids)
+    to_places = np.unique(to_ids)
+    if len(from_places) != len(to_places):
+        return None, None
+    matrix = np.full((len(from_places), len(to_places)), np.nan)
+    matrix[np.searchsorted(from_places, from_ids), np.searchsorted(to_places, to_ids)] = values
+    return matrix, from_places
+
+# stream the rows from the database into a sparse (CSR) matrix, keeping only the
+# pairs with an impedence <= max_impedence. The place ids are collected from every
+# row, so places without any kept pairs still get a row/column
+def fetch_sparse_impedence_matrix(session, table, impedence, max_impedence=None, chunk_size=500000):
+    query = select(table.fromplaceid, table.toplaceid, impedence).execution_options(yield_per=chunk_size)
+    from_places = np.empty(0, dtype=np.int64)
+    to_places = np.empty(0, dtype=np.int64)
+    kept = [np.empty((0, 3))]
+    for rows in session.execute(query).partitions():
+        chunk = np.array([tuple(row) for row in rows], dtype=float)
+        from_places = np.union1d(from_places, chunk[:, 0].astype(np.int64))
+        to_places = np.union1d(to_places, chunk[:, 1].astype(np.int64))
+        keep = ~np.isnan(chunk[:, 2])
+        if max_impedence is not None:
+            keep &= chunk[:, 2] <= max_impedence
+        kept.append(chunk[keep])
+    if len(from_places) != len(to_places):
+        return None, None
+    kept = np.concatenate(kept)
+    rows = np.searchsorted(from_places, kept[:, 0].astype(np.int64))
+    cols = np.searchsorted(to_places, kept[:, 1].astype(np.int64))
+    matrix = sparse.csr_matrix((kept[:, 2], (rows, cols)), shape=(len(from_places), len(to_places)))
+    return matrix, from_places
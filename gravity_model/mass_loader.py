@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Loads the supply and demand masses of every trade commodity in a single streamed
+query, and lays them out as (commodity x trade place) arrays whose columns are in
+the same order as the rows/columns of the impedence matrix.
+
+"""
+
+import numpy as np
+from sqlalchemy import select
+
+
+# stream the masses from the database into (commodity x place) supply and demand arrays
+# place_ids gives the column order (the trade place ids of the impedence matrix), and
+# commodity_ids optionally limits the commodities that are loaded.
+# returns the commodity ids (the array rows), supply, demand and a flag for each commodity
+# that is True when it has exactly one row for every place in place_ids
+def fetch_masses(session, table, place_ids, commodity_ids=None, chunk_size=500000):
+    query = select(table.trade_commodity_id, table.tradeplace_id, table.supply_amount, table.demand_amount)
+    if commodity_ids is not None:
+        query = query.where(table.trade_commodity_id.in_([int(x) for x in commodity_ids]))
+    query = query.execution_options(yield_per=chunk_size)
+    chunks = [np.array([tuple(row) for row in rows], dtype=float) for rows in session.execute(query).partitions()]
+    rows = np.concatenate(chunks) if chunks else np.empty((0, 4))
+
+    commodities, commodity_index = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    places = rows[:, 1].astype(np.int64)
+    # find the column of each row's place, marking places that aren't in the impedence matrix
+    place_ids = np.asarray(place_ids)
+    sorter = np.argsort(place_ids)
+    position = np.clip(np.searchsorted(place_ids, places, sorter=sorter), 0, len(place_ids) - 1)
+    place_index = sorter[position]
+    known = place_ids[place_index] == places
+
+    supply = np.zeros((len(commodities), len(place_ids)))
+    demand = np.zeros((len(commodities), len(place_ids)))
+    # missing (NULL) masses are treated as zero
+    supply[commodity_index[known], place_index[known]] = np.nan_to_num(rows[known, 2])
+    demand[commodity_index[known], place_index[known]] = np.nan_to_num(rows[known, 3])
+
+    row_counts = np.bincount(commodity_index, minlength=len(commodities))
+    place_counts = np.zeros((len(commodities), len(place_ids)), dtype=np.int32)
+    np.add.at(place_counts, (commodity_index[known], place_index[known]), 1)
+    complete = (row_counts == len(place_ids)) & np.all(place_counts == 1, axis=1)
+    return commodities, supply, demand, complete
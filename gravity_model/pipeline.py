@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+A small staged pipeline that overlaps input and output with computation.
+
+A loader thread prepares item k+1 and a writer thread saves the result of item
+k-1 while the calling thread computes item k. The stages are connected by
+bounded queues, so at most a few items are held in memory at once. numpy
+releases the GIL for the heavy array work, so the three stages really do run
+at the same time.
+
+"""
+
+import queue
+import threading
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+# run load -> compute -> write over items
+# load(item) runs on the loader thread, compute(item, loaded) on the calling thread and
+# write(item, computed) on the writer thread. queue_size bounds how many loaded inputs
+# and computed outputs can wait between the stages.
+# compute results are passed on to write and not kept, so callers collect whatever they
+# need inside their stage functions. An error in any stage stops the pipeline and is
+# raised in the calling thread.
+def run_pipeline(items, load, compute, write, queue_size=1):
+    loaded = queue.Queue(maxsize=queue_size)
+    computed = queue.Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+
+    # put an item on a queue, giving up if the pipeline has been stopped
+    def put(q, value):
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def loader():
+        try:
+            for item in items:
+                if not put(loaded, (item, load(item))):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(loaded, _DONE)
+
+    def writer():
+        try:
+            while True:
+                value = computed.get()
+                if value is _DONE:
+                    return
+                if not stop.is_set():
+                    write(*value)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            # keep draining so the calling thread is never blocked on a full queue
+            while computed.get() is not _DONE:
+                pass
+
+    loader_thread = threading.Thread(target=loader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    loader_thread.start()
+    writer_thread.start()
+
+    try:
+        while not stop.is_set():
+            try:
+                value = loaded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if value is _DONE:
+                break
+            item, inputs = value
+            computed.put((item, compute(item, inputs)))
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        computed.put(_DONE)
+        writer_thread.join()
+        stop.set()
+        loader_thread.join()
+
+    if errors:
+        raise errors[0]
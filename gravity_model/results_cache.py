@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Keeps track of which commodity results in the output folder are still valid, so
+that reruns only recompute commodities whose inputs changed and interrupted runs
+can be resumed.
+
+Every commodity result is recorded under a key made from a hash of its supply and
+demand masses, a fingerprint of the impedence matrix and the model parameters. The
+records are small json files in output/manifest (one per commodity, written after
+the result itself, so a crash never leaves a record for a missing result). A run
+manifest in output/run_manifest.json describes the latest run.
+
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from scipy import sparse
+
+
+# content hash of one or more arrays (dense or sparse)
+def array_fingerprint(*arrays):
+    digest = hashlib.sha256()
+    for array in arrays:
+        if sparse.issparse(array):
+            array = sparse.csr_matrix(array)
+            parts = (array.data, array.indices, array.indptr)
+        else:
+            parts = (array,)
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            digest.update(repr((part.shape, part.dtype.str)).encode('utf-8'))
+            # hash large arrays in blocks so memory mapped files aren't read at once
+            flat = part.reshape(-1)
+            for start in range(0, len(flat), 1 << 24):
+                digest.update(flat[start:start + (1 << 24)].tobytes())
+    return digest.hexdigest()
+
+# key of one commodity result
+def result_key(supply, demand, impedence_fingerprint, parameters):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(supply, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(demand, dtype=np.float64).tobytes())
+    digest.update(impedence_fingerprint.encode('utf-8'))
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def manifest_dir(output_dir):
+    return os.path.join(output_dir, 'manifest')
+
+# write json to a file atomically
+def _write_json(path, data):
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+# read every commodity record in the output folder
+# returns a dictionary of trade id -> record
+def load_manifest(output_dir='./output'):
+    records = {}
+    directory = manifest_dir(output_dir)
+    if not os.path.isdir(directory):
+        return records
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        records[int(record['trade_id'])] = record
+    return records
+
+# True if the recorded result has the expected key and its output still exists
+def is_valid(record, key):
+    return record is not None and record.get('key') == key and os.path.exists(record.get('path', ''))
+
+# record a finished commodity result (call after the result has been written)
+def record_result(trade_id, key, path, output_dir='./output'):
+    os.makedirs(manifest_dir(output_dir), exist_ok=True)
+    record = {
+        'trade_id': int(trade_id),
+        'key': key,
+        'path': path,
+        'completed_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    _write_json(os.path.join(manifest_dir(output_dir), '{0}.json'.format(int(trade_id))), record)
+
+# write the manifest that describes a run
+def write_run_manifest(run_info, output_dir='./output'):
+    os.makedirs(output_dir, exist_ok=True)
+    _write_json(os.path.join(output_dir, 'run_manifest.json'), run_info)
@@ -10,19 +10,24 @@ trade places.
 
 #from psycopg2 import sql
 import pandas as pd
-from gravity_trade import GravityModel
+from gravity_trade import GravityModel, SparseGravityModel, LeanGravityModel, BatchGravityModel, cost_matrix, truncate_impedence
 import argparse
 from dotenv import load_dotenv
 import os
-from concurrent.futures import ThreadPoolExecutor as Pool
-#from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor as Pool
+from shared_arrays import share_matrix, attach_matrix, release
+from shipment_io import save_shipments, shipment_path, OUTPUT_FORMATS
+from pipeline import run_pipeline
+from results_cache import array_fingerprint, result_key, load_manifest, is_valid, record_result, write_run_manifest
+from mass_loader import fetch_masses
+from impedance_cache import table_fingerprint, load_cached_matrix, save_cached_matrix, fetch_impedence_rows, build_impedence_matrix, fetch_sparse_impedence_matrix
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from itertools import repeat
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.session import close_all_sessions
 import time 
 import numpy as np
+from scipy import sparse
 import sys 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -41,6 +46,21 @@ Session = scoped_session(session_factory)
 parser = argparse.ArgumentParser(description='This program pulls an impedence matrix and supply/demand data from a postgres database, and runs the gravity model on the data. The output is a matrix of shipments between trade palces.')
 parser.add_argument('-impedence', help="The name of the impedence that you wish to use as input to the gravity model. This parameter is required. Options include: hwyimpedence, rrimpedence, waterimpedence, and comboimpedence.", required=True)
 parser.add_argument('-trade_commodity_id', help="The trade commodity index that you wish to calculate. If this parameter is not specified, the program will be ran for every commodity.", required=False)
+parser.add_argument('-tolerance', type=float, default=1e-6, help="The relative row total error at which balancing of A and B stops. The default value is 1e-6.", required=False)
+parser.add_argument('-max_iterations', type=int, default=100, help="The maximum number of balancing sweeps for A and B. The default value is 100.", required=False)
+parser.add_argument('-accelerator', choices=['overrelax', 'anderson'], help="Optional accelerator applied to the balancing factors. Options include: overrelax and anderson.", required=False)
+parser.add_argument('-max_impedence', type=float, help="Run the sparse gravity model, dropping trade place pairs with an impedence above this value.", required=False)
+parser.add_argument('-top_k', type=int, help="Run the sparse gravity model, keeping only this many of the closest destinations for each origin.", required=False)
+parser.add_argument('-lean', action='store_true', help="Run the memory-lean version of the model.", required=False)
+parser.add_argument('-float32', action='store_true', help="Run the memory-lean version of the model in single precision (implies -lean).", required=False)
+parser.add_argument('-measure_memory', action='store_true', help="Report the peak memory of the memory-lean model for each commodity (implies -lean). The commodities are then run one after another, without preparing inputs and writing outputs on separate threads, so that only the model's own memory is measured. This is slower.", required=False)
+parser.add_argument('-cache_dir', default='./cache', help="The folder where the pivoted impedence matrix is cached between runs. The default is ./cache.", required=False)
+parser.add_argument('-no_cache', action='store_true', help="Always rebuild the impedence matrix from the database, without reading or writing the cache.", required=False)
+parser.add_argument('-output_format', choices=OUTPUT_FORMATS, default='csv', help="The format of the shipment output. Options include: csv (dense matrix), npz (compressed sparse matrix) and parquet (from, to, commodity, flow dataset partitioned by commodity, requires pyarrow). The default is csv.", required=False)
+parser.add_argument('-force', action='store_true', help="Recompute every commodity, even if a valid result from an earlier run is already in the output folder.", required=False)
+parser.add_argument('-prefetch', type=int, default=1, help="How many commodities each worker prepares ahead of, and keeps waiting to be written behind, the one being calculated. The default is 1.", required=False)
+parser.add_argument('-workers', type=int, default=1, help="The number of worker processes to run the commodities on. Only the impedence and cost matrices are shared: every worker holds several private trade place x trade place matrices of its own (about 136 MB each in double precision for 4135 trade places), so memory use grows with the number of workers. -lean keeps about one such matrix per worker and -float32 halves it. The default is 1.", required=False)
+parser.add_argument('-batch_size', type=int, help="Run the commodities in blocks of this size. The cost matrix is calculated once and shared by every block. If this parameter is not specified, each commodity is ran on its own.", required=False)
 
 impedence_vars = {
     'hwyimpedence': Impedances.hwyimpedence,
@@ -49,67 +69,201 @@ impedence_vars = {
     'comboimpedence': Impedances.comboimpedence
 }
 
-# get impedence matrix from database
-def get_impedence_matrix(impedence_var):
+# get impedence matrix from database (or from the local cache if the table hasn't changed)
+# returns the matrix and the trade place ids of its rows/columns
+def get_impedence_matrix(impedence_var, cache_dir='./cache', use_cache=True):
     session = Session()
     impedence = impedence_vars.get(impedence_var)
     if not impedence:
         print('ERROR: INVALID IMPEDENCE VARIABLE')
         exit()
-    query = session.query(Impedances.fromplaceid, Impedances.toplaceid, impedence).all()
-    df = pd.DataFrame(query, columns=['fromplaceid', 'toplaceid', impedence_var])
-    if len(df['fromplaceid'].unique()) != len(df['toplaceid'].unique()):
+    if use_cache:
+        fingerprint = table_fingerprint(session, Impedances, impedence)
+        cached = load_cached_matrix(cache_dir, impedence_var, fingerprint)
+        if cached is not None:
+            print('loaded matrix from cache')
+            session.close()
+            return cached
+    from_ids, to_ids, values = fetch_impedence_rows(session, Impedances, impedence)
+    session.close()
+    matrix, place_ids = build_impedence_matrix(from_ids, to_ids, values)
+    if matrix is None:
         print('ERROR: FIPS MATRIX NOT SQUARE')
         exit()
-    df = df.pivot_table(values=impedence_var, index='fromplaceid', columns='toplaceid')
-    matrix = df.to_numpy()
+    if use_cache:
+        save_cached_matrix(cache_dir, impedence_var, fingerprint, matrix, place_ids)
     print('finished matrix')
-    session.close()
-    return matrix
+    return matrix, place_ids
 
-# get supply and demand data from database
-def get_supply_demand(commodity_id):
+# get a sparse impedence matrix that only keeps nearby trade place pairs
+# a cached dense matrix is used when there is one, otherwise the rows are streamed
+# from the database without ever building the dense matrix
+def get_sparse_impedence_matrix(impedence_var, max_impedence=None, top_k=None, cache_dir='./cache', use_cache=True):
     session = Session()
-    query = session.query(Masses.tradeplace_id, Masses.supply_amount, Masses.demand_amount).filter(Masses.trade_commodity_id == commodity_id).all()
-    supp_demand_df = pd.DataFrame(query, columns=['tradeplace_id', 'supply_amount', 'demand_amount'])
-    session.close()
-    return supp_demand_df
+    impedence = impedence_vars.get(impedence_var)
+    if not impedence:
+        print('ERROR: INVALID IMPEDENCE VARIABLE')
+        exit()
+    cached = None
+    if use_cache:
+        fingerprint = table_fingerprint(session, Impedances, impedence)
+        cached = load_cached_matrix(cache_dir, impedence_var, fingerprint)
+    if cached is not None:
+        session.close()
+        dense_matrix, place_ids = cached
+        matrix = truncate_impedence(dense_matrix, max_impedence, top_k)
+    else:
+        matrix, place_ids = fetch_sparse_impedence_matrix(session, Impedances, impedence, max_impedence)
+        session.close()
+        if matrix is None:
+            print('ERROR: FIPS MATRIX NOT SQUARE')
+            exit()
+        if top_k:
+            matrix = truncate_impedence(matrix, top_k=top_k)
+    print('finished sparse matrix: {0} of {1} trade place pairs kept'.format(matrix.nnz, matrix.shape[0] * matrix.shape[1]))
+    return matrix, place_ids
 
-# get list of trade commodity ids
-def get_trade_commodity_id():
+# get the supply and demand data of every commodity (or of commodity_ids) in one streamed query
+# returns the commodity ids and (commodity x place) supply and demand arrays whose columns
+# follow place_ids (the impedence matrix order). Commodities that don't have exactly one
+# row for every trade place are reported and flagged in the returned complete array
+def get_all_supply_demand(place_ids, commodity_ids=None):
     session = Session()
-    query = session.query(Masses.trade_commodity_id).distinct().all()
-    trade_commodity_id = pd.DataFrame(query, columns=['trade_commodity_id'])['trade_commodity_id'].unique().tolist()
+    commodities, supply, demand, complete = fetch_masses(session, Masses, place_ids, commodity_ids)
     session.close()
-    return trade_commodity_id
+    for trade_id in commodities[~complete]:
+        print('ERROR: SUPPLY DEMAND AND IMPEDENCE MATRIX NOT SAME SIZE FOR: TRADE ID {0}'.format(trade_id))
+    return commodities, supply, demand, complete
 
-# run the gravity model
-def main(imp_matrix, trade_id):
-    start_time = time.time()
-    supp_demand_df = get_supply_demand(trade_id)
+# build the supply/demand data frame of one commodity from the bulk arrays
+def supply_demand_frame(place_ids, supply, demand):
+    return pd.DataFrame({'tradeplace_id': place_ids, 'supply_amount': supply, 'demand_amount': demand})
+
+# run the gravity model for one commodity
+# returns the model (with the shipment matrix in gravity_model.S), or None if the data don't fit
+# measure_memory reports the peak memory of the lean model (see LeanGravityModel.run)
+def run_gravity_model(imp_matrix, trade_id, supp_demand_df, solver_options=None, cost_mat=None, lean_dtype=None, measure_memory=False):
     # check that the impedence matrix and supply/demand data are the same size
     if len(supp_demand_df) != imp_matrix.shape[0] or len(supp_demand_df) != imp_matrix.shape[1]:
         print('ERROR: SUPPLY DEMAND AND IMPEDENCE MATRIX NOT SAME SIZE')
         print(len(supp_demand_df))
         print(imp_matrix.shape)
-        return
+        return None
 
     # run the gravity model found in gravity_trade.py
-    gravity_model = GravityModel(imp_matrix, supp_demand_df)
-    gravity_model.format_data()
-    gravity_model.calculate_cost_matrix()
-    gravity_model.calculate_attraction_matrices()
-    gravity_model.calculate_A_and_B()
-    gravity_model.calculate_prob_matrix()
-    gravity_model.calculate_shipping_matrix()
+    if lean_dtype is not None and not sparse.issparse(imp_matrix):
+        gravity_model = LeanGravityModel(imp_matrix, supp_demand_df, cost_mat, lean_dtype)
+        gravity_model.run(measure_memory, **(solver_options or {}))
+        if measure_memory:
+            print('Trade ID {0}: balanced in {1} iterations, residual {2}, peak memory {3:.1f} MB'.format(trade_id, gravity_model.iterations, gravity_model.residual, gravity_model.peak_memory / 1e6))
+        else:
+            print('Trade ID {0}: balanced in {1} iterations, residual {2}'.format(trade_id, gravity_model.iterations, gravity_model.residual))
+    else:
+        if sparse.issparse(imp_matrix):
+            gravity_model = SparseGravityModel(imp_matrix, supp_demand_df, cost_mat)
+        else:
+            gravity_model = GravityModel(imp_matrix, supp_demand_df, cost_mat)
+        gravity_model.format_data()
+        gravity_model.calculate_cost_matrix()
+        gravity_model.calculate_attraction_matrices()
+        gravity_model.calculate_A_and_B(**(solver_options or {}))
+        print('Trade ID {0}: balanced in {1} iterations, residual {2}'.format(trade_id, gravity_model.iterations, gravity_model.residual))
+        gravity_model.calculate_prob_matrix()
+        gravity_model.calculate_shipping_matrix()
     # make sure that supply and demand are balanced
     if abs(gravity_model.total_shipped_supply - gravity_model.total_shipped_demand) > 1:
         print('ERROR: SUPPLY AND DEMAND NOT BALANCED FOR: TRADE ID {0}'.format(trade_id))
-    # save the output to a csv file in the output folder (this directory isn't tracked by git)
-    pd.DataFrame(data=gravity_model.S).to_csv('./output/S_shipments_trip_matrix_tci_{0}.csv'.format(trade_id))
+    return gravity_model
+
+# run the gravity model for a block of commodities against a shared cost matrix
+# supply and demand are (commodity x place) arrays for trade_ids (see get_all_supply_demand)
+def run_batch(cost_mat, trade_ids, supply, demand, solver_options=None, output_format='csv'):
+    start_time = time.time()
+    block_ids = list(trade_ids)
+
+    # the accelerators are only available for single commodity runs
+    solver_options = dict(solver_options or {})
+    if solver_options.pop('accelerator', None):
+        raise ValueError('the accelerators can not be used with batches')
+    gravity_model = BatchGravityModel(None, cost_mat=cost_mat)
+    gravity_model.format_data(supply, demand)
+    gravity_model.calculate_A_and_B(**solver_options)
+    print('Block balanced in {0} iterations, max residual {1}'.format(gravity_model.iterations, np.max(gravity_model.residual)))
+
+    def compute(k, loaded):
+        S = gravity_model.calculate_shipping_matrix(k)
+        # make sure that supply and demand are balanced
+        if abs(gravity_model.total_shipped_supply - gravity_model.total_shipped_demand) > 1:
+            print('ERROR: SUPPLY AND DEMAND NOT BALANCED FOR: TRADE ID {0}'.format(block_ids[k]))
+        return S
+
+    def write(k, S):
+        save_shipments(S, block_ids[k], output_format)
+
+    # the shipment matrices are written on a separate thread while the next one is calculated
+    run_pipeline(range(len(block_ids)), lambda k: None, compute, write)
     end_time = time.time()
-    print('Runtime: ', end_time - start_time, ' seconds')
-    return end_time - start_time
+    print('Block runtime: ', end_time - start_time, ' seconds for ', len(block_ids), ' commodities')
+    return (end_time - start_time) / len(block_ids)
+
+# arrays shared with the worker processes (filled in by init_worker)
+shared = {}
+
+# attach a worker process to the shared impedence and cost matrices
+def init_worker(descriptors, options):
+    # database connections inherited from the parent process can't be reused
+    engine.dispose(close=False)
+    for key, descriptor in descriptors.items():
+        shared[key] = attach_matrix(descriptor)
+    shared.update(options)
+
+# run a chunk of commodities in a worker process
+# the supply/demand data of the next commodity are prepared and the output of the
+# previous commodity is written on separate threads while the current one is calculated
+def run_shared(trade_ids):
+    runtimes = []
+
+    def load(trade_id):
+        k = shared['commodity_index'][trade_id]
+        return supply_demand_frame(shared['place_ids'], shared['supply'][1][k], shared['demand'][1][k])
+
+    def compute(trade_id, supp_demand_df):
+        start_time = time.time()
+        gravity_model = run_gravity_model(
+            shared['imp_matrix'][1],
+            trade_id,
+            supp_demand_df,
+            solver_options=shared['solver_options'],
+            cost_mat=shared['cost_mat'][1],
+            lean_dtype=shared['lean_dtype'],
+            measure_memory=shared['measure_memory'],
+        )
+        return (start_time, gravity_model.S if gravity_model is not None else None)
+
+    def write(trade_id, computed):
+        start_time, S = computed
+        if S is None:
+            return
+        path = save_shipments(S, trade_id, shared['output_format'])
+        record_result(trade_id, shared['result_keys'][trade_id], path)
+        runtimes.append(time.time() - start_time)
+        print('Runtime: ', runtimes[-1], ' seconds')
+
+    if shared['measure_memory']:
+        # no loader or writer thread may allocate while the memory of a commodity is measured
+        for trade_id in trade_ids:
+            write(trade_id, compute(trade_id, load(trade_id)))
+    else:
+        run_pipeline(trade_ids, load, compute, write, shared['prefetch'])
+    return np.mean(runtimes) if runtimes else None
+
+# run a block of commodities in a worker process
+def run_shared_batch(trade_ids):
+    rows = [shared['commodity_index'][trade_id] for trade_id in trade_ids]
+    runtime = run_batch(shared['cost_mat'][1], trade_ids, shared['supply'][1][rows], shared['demand'][1][rows], shared['solver_options'], shared['output_format'])
+    for trade_id in trade_ids:
+        record_result(trade_id, shared['result_keys'][trade_id], shipment_path(trade_id, shared['output_format']))
+    return runtime
 
 # only run the program if this file is called directly
 if __name__ == '__main__':
@@ -117,31 +271,128 @@ if __name__ == '__main__':
     args = parser.parse_args()
     impedence_var = args.impedence
     start_time = time.time()
-    imp_matrix = get_impedence_matrix(impedence_var)
-    end_time = time.time()
-    print('Matrix time: ', end_time - start_time, ' seconds')
-    trade_comm_id_list = get_trade_commodity_id()
+    sparse_mode = args.max_impedence is not None or args.top_k is not None
+    if sparse_mode and args.batch_size:
+        print('ERROR: THE SPARSE MODEL CAN NOT BE RAN IN BATCHES')
+        exit()
+    if args.accelerator and args.batch_size:
+        print('ERROR: THE ACCELERATORS CAN NOT BE USED WITH BATCHES')
+        exit()
+    trade_id = None
     if args.trade_commodity_id:
         try:
-            int(args.trade_commodity_id)
+            trade_id = int(args.trade_commodity_id)
         except ValueError:
             print('ERROR: INVALID TRADE COMMODITY ID')
             exit()
-        if int(args.trade_commodity_id) in trade_comm_id_list:
-            trade_list = [int(args.trade_commodity_id)]
-        else:
-            print('ERROR: INVALID TRADE COMMODITY ID')
-            exit()
+    if sparse_mode:
+        imp_matrix, place_ids = get_sparse_impedence_matrix(impedence_var, args.max_impedence, args.top_k, args.cache_dir, not args.no_cache)
     else:
-        trade_list = get_trade_commodity_id()
+        imp_matrix, place_ids = get_impedence_matrix(impedence_var, args.cache_dir, not args.no_cache)
+    end_time = time.time()
+    print('Matrix time: ', end_time - start_time, ' seconds')
+    # load the masses of every commodity (or only of -trade_commodity_id) at once, aligned to the impedence matrix
+    start_time = time.time()
+    commodities, supply, demand, complete = get_all_supply_demand(place_ids, None if trade_id is None else [trade_id])
+    print('Masses time: ', time.time() - start_time, ' seconds')
+    commodity_index = {int(commodity): k for k, commodity in enumerate(commodities)}
+    trade_list = [int(commodity) for commodity in commodities[complete]]
+    if trade_id is not None and trade_list != [trade_id]:
+        print('ERROR: INVALID TRADE COMMODITY ID')
+        exit()
     #trade_list = [5041, 5348, 5134, 5120]
-    if len(trade_list) == 1:
-        process_count = 1
+    solver_options = {
+        'tol': args.tolerance,
+        'max_iterations': args.max_iterations,
+        'accelerator': args.accelerator,
+    }
+    lean_dtype = None
+    if args.lean or args.float32 or args.measure_memory:
+        lean_dtype = np.float32 if args.float32 else np.float64
+
+    # skip the commodities whose results from an earlier (or interrupted) run are still valid
+    impedence_fingerprint = array_fingerprint(imp_matrix)
+    parameters = {
+        'impedence': impedence_var,
+        'solver_options': solver_options,
+        'max_impedence': args.max_impedence,
+        'top_k': args.top_k,
+        'lean_dtype': np.dtype(lean_dtype).name if lean_dtype is not None else None,
+        'batch': bool(args.batch_size),
+        'output_format': args.output_format,
+    }
+    result_keys = {}
+    for trade_id in trade_list:
+        k = commodity_index[trade_id]
+        result_keys[trade_id] = result_key(supply[k], demand[k], impedence_fingerprint, parameters)
+    manifest = {} if args.force else load_manifest()
+    skipped = [trade_id for trade_id in trade_list if is_valid(manifest.get(trade_id), result_keys[trade_id])]
+    skipped_set = set(skipped)
+    trade_list = [trade_id for trade_id in trade_list if trade_id not in skipped_set]
+    print('Skipping {0} commodities with valid results, running {1}'.format(len(skipped), len(trade_list)))
+    run_info = {
+        'started_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'status': 'running',
+        'impedence_fingerprint': impedence_fingerprint,
+        'parameters': parameters,
+        'skipped': skipped,
+        'pending': trade_list,
+    }
+    write_run_manifest(run_info)
+    if not trade_list:
+        run_info['status'] = 'completed'
+        write_run_manifest(run_info)
+        print('All results are up to date')
+        exit()
+
+    if args.batch_size:
+        tasks = [trade_list[i:i + args.batch_size] for i in range(0, len(trade_list), args.batch_size)]
+        task_function = run_shared_batch
+        process_count = max(1, min(args.workers, len(tasks)))
     else:
-        process_count = 2
-    with Pool(process_count) as pool:
-        results = list(pool.map(main, repeat(imp_matrix), trade_list))
-    average_run_time = np.mean(results)
+        # each worker runs chunks of commodities through its own load/compute/write pipeline
+        process_count = max(1, min(args.workers, len(trade_list)))
+        chunk_size = max(1, len(trade_list) // (process_count * 4))
+        tasks = [trade_list[i:i + chunk_size] for i in range(0, len(trade_list), chunk_size)]
+        task_function = run_shared
+
+    # the cost matrix is the same for every commodity, so only calculate it once.
+    # both matrices are placed in shared memory so the workers don't copy them
+    # in the lean single precision mode the shared cost matrix is also single precision
+    cost_mat = cost_matrix(imp_matrix)
+    if lean_dtype is not None and not sparse_mode and not args.batch_size:
+        cost_mat = cost_mat.astype(lean_dtype, copy=False)
+    imp_blocks, imp_descriptor = share_matrix(imp_matrix)
+    cost_blocks, cost_descriptor = share_matrix(cost_mat)
+    supply_blocks, supply_descriptor = share_matrix(supply)
+    demand_blocks, demand_descriptor = share_matrix(demand)
+    imp_matrix = None
+    cost_mat = None
+    descriptors = {
+        'imp_matrix': imp_descriptor,
+        'cost_mat': cost_descriptor,
+        'supply': supply_descriptor,
+        'demand': demand_descriptor,
+    }
+    options = {
+        'place_ids': place_ids,
+        'commodity_index': commodity_index,
+        'solver_options': solver_options,
+        'output_format': args.output_format,
+        'lean_dtype': lean_dtype,
+        'result_keys': result_keys,
+        'prefetch': args.prefetch,
+        'measure_memory': args.measure_memory,
+    }
+    try:
+        with Pool(process_count, initializer=init_worker, initargs=(descriptors, options)) as pool:
+            results = list(pool.map(task_function, tasks))
+    finally:
+        release(imp_blocks + cost_blocks + supply_blocks + demand_blocks)
+    run_info['status'] = 'completed'
+    run_info['completed_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    write_run_manifest(run_info)
+    average_run_time = np.mean([result for result in results if result is not None])
     print('Average runtime: ', average_run_time)
     close_all_sessions()
 
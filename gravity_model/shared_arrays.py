@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Helpers for placing numpy arrays in shared memory, so that worker processes
+can attach to large matrices (e.g. the impedence and cost matrices) without
+each process holding its own copy.
+
+"""
+
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import sparse
+
+
+# copy an array into a new shared memory block
+# returns the shared memory block (the caller must close and unlink it) and a
+# small picklable descriptor that workers use to attach to the array
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    descriptor = (shm.name, array.shape, array.dtype.str)
+    return shm, descriptor
+
+# attach to an array that was shared with share_array
+# the shared memory block must be kept alive for as long as the array is used
+def attach_array(descriptor):
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shm, array
+
+# share a dense array or a sparse (CSR) matrix
+# returns a list of shared memory blocks and a descriptor for attach_matrix
+def share_matrix(matrix):
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix)
+        shared = [share_array(part) for part in (matrix.data, matrix.indices, matrix.indptr)]
+        blocks = [shm for shm, descriptor in shared]
+        descriptor = ('csr', matrix.shape, [descriptor for shm, descriptor in shared])
+        return blocks, descriptor
+    shm, descriptor = share_array(matrix)
+    return [shm], ('dense', descriptor)
+
+# attach to a matrix that was shared with share_matrix
+def attach_matrix(descriptor):
+    if descriptor[0] == 'csr':
+        shape, part_descriptors = descriptor[1], descriptor[2]
+        attached = [attach_array(part) for part in part_descriptors]
+        data, indices, indptr = (array for shm, array in attached)
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        return [shm for shm, array in attached], matrix
+    shm, array = attach_array(descriptor[1])
+    return [shm], array
+
+# close and remove shared memory blocks created by share_array
+def release(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
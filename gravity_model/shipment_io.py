@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Writes and reads the shipment matrices produced by the gravity model.
+
+Three output formats are supported:
+    csv     - the dense matrix as a csv file (one file per commodity)
+    npz     - a compressed sparse (CSR) matrix saved with scipy (one file per commodity)
+    parquet - a (from, to, commodity, flow) table of the non-zero flows, written as a
+              dataset partitioned by commodity. This format requires pyarrow.
+
+Flows below 1 are already set to zero by the gravity model, so the sparse formats
+only store a small share of the matrix. The from and to columns are the row and
+column positions of the impedence matrix, the same as the csv index and header.
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+OUTPUT_FORMATS = ['csv', 'npz', 'parquet']
+
+
+# path of the output for one commodity, given the output format
+def shipment_path(trade_id, output_format='csv', output_dir='./output'):
+    if output_format == 'csv':
+        return os.path.join(output_dir, 'S_shipments_trip_matrix_tci_{0}.csv'.format(trade_id))
+    if output_format == 'npz':
+        return os.path.join(output_dir, 'S_shipments_trip_matrix_tci_{0}.npz'.format(trade_id))
+    if output_format == 'parquet':
+        return os.path.join(output_dir, 'shipments', 'commodity={0}'.format(trade_id), 'part-0.parquet')
+    raise ValueError('unknown output format: {0}'.format(output_format))
+
+# save the shipment matrix for one commodity
+def save_shipments(S, trade_id, output_format='csv', output_dir='./output'):
+    path = shipment_path(trade_id, output_format, output_dir)
+    if output_format == 'csv':
+        pd.DataFrame(data=S.toarray() if sparse.issparse(S) else S).to_csv(path)
+    elif output_format == 'npz':
+        sparse.save_npz(path, sparse.csr_matrix(S), compressed=True)
+    else:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('the parquet output format requires pyarrow (pip install pyarrow)')
+        flows = sparse.coo_matrix(S)
+        # the commodity column comes from the partition directory
+        table = pa.table({
+            'from': flows.row.astype(np.int32),
+            'to': flows.col.astype(np.int32),
+            'flow': flows.data.astype(np.float64),
+        })
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path)
+    return path
+
+# read a csv or npz shipment matrix
+# returns a scipy CSR matrix, or a dense numpy array if dense is True
+def read_shipment_matrix(path, dense=False):
+    if path.endswith('.npz'):
+        S = sparse.load_npz(path).tocsr()
+        return S.toarray() if dense else S
+    S = pd.read_csv(path, index_col=0).to_numpy()
+    return S if dense else sparse.csr_matrix(S)
+
+# read the parquet shipment dataset as a (from, to, commodity, flow) DataFrame
+# trade_ids optionally limits the commodities that are read
+def read_shipment_table(output_dir='./output', trade_ids=None):
+    filters = None
+    if trade_ids is not None:
+        filters = [('commodity', 'in', [int(trade_id) for trade_id in trade_ids])]
+    df = pd.read_parquet(os.path.join(output_dir, 'shipments'), filters=filters)
+    df['commodity'] = df['commodity'].astype(int)
+    return df[['from', 'to', 'commodity', 'flow']]